@@ -54,6 +54,49 @@ class Config:
     AWS_KEY_ID = environ.get("BUCKETEER_AWS_ACCESS_KEY_ID")
     AWS_SECRET_KEY = environ.get("BUCKETEER_AWS_SECRET_ACCESS_KEY")
     AWS_REGION = environ.get("BUCKETEER_AWS_REGION")
+    # Local copy of the data/ files, synced in the background
+    S3_MIRROR_ENABLED = str_to_bool(environ.get("S3_MIRROR_ENABLED", True))
+    S3_MIRROR_DIRECTORY = environ.get("S3_MIRROR_DIRECTORY", "./s3_mirror")
+    # Seconds between two syncs and maximal age of the last sync to serve from it
+    S3_MIRROR_INTERVAL = int(environ.get("S3_MIRROR_INTERVAL", 30))
+    S3_MIRROR_MAX_STALENESS = int(environ.get("S3_MIRROR_MAX_STALENESS", 120))
+
+    # Keep the universe as a memory mapped Arrow IPC file on local disk
+    DISPERSION_MEMORY_MAP = str_to_bool(environ.get("DISPERSION_MEMORY_MAP", True))
+    DISPERSION_MEMORY_MAP_DIRECTORY = environ.get(
+        "DISPERSION_MEMORY_MAP_DIRECTORY", "./datasets"
+    )
+
+    # Parsed datasets are published here once and memory mapped by all workers,
+    # empty to keep them in the memory of every worker. Off by default next to the
+    # memory mapped universe, which would otherwise be copied into shared memory.
+    SHARED_DATASET_DIRECTORY = environ.get(
+        "SHARED_DATASET_DIRECTORY",
+        (
+            "/dev/shm/etf-portfolios"
+            if path.isdir("/dev/shm") and not DISPERSION_MEMORY_MAP
+            else ""
+        ),
+    )
+
+    # Calibration
+    CALIBRATION_WORKERS = int(environ.get("CALIBRATION_WORKERS", 1))
+    CALIBRATION_SHARD_SIZE = int(environ.get("CALIBRATION_SHARD_SIZE", 16))
+    CALIBRATION_BATCH_SIZE = int(environ.get("CALIBRATION_BATCH_SIZE", 100_000))
+    # One of csv, parquet or arrow
+    CALIBRATION_RESULT_FORMAT = environ.get("CALIBRATION_RESULT_FORMAT", "parquet")
+    # Tie breakers after CAGR for the top X selection, comma separated: risk, age
+    CALIBRATION_TOP_X_KEYS = environ.get("CALIBRATION_TOP_X_KEYS", "risk").split(",")
+    # Megabytes of normalised price columns every calibration process memoizes
+    CALIBRATION_NORMALISATION_CACHE_MB = int(
+        environ.get("CALIBRATION_NORMALISATION_CACHE_MB", 256)
+    )
+    # Store the curves of the top X portfolios for the performance plot
+    CALIBRATION_CURVE_STORE = str_to_bool(environ.get("CALIBRATION_CURVE_STORE", False))
+    # Seconds between two checkpoints of a running calibration
+    CALIBRATION_CHECKPOINT_INTERVAL = int(
+        environ.get("CALIBRATION_CHECKPOINT_INTERVAL", 60)
+    )
 
     PAYPAL_SANDBOX = environ.get("PAYPAL_SANDBOX", False)
     PAYPAL_CLIENT_ID = environ.get("PAYPAL_CLIENT_ID")
@@ -20,6 +20,7 @@ from dash_iconify import DashIconify
 
 from src.Dash.components.header import make_header
 from src.Dash.services.calculation import LocalAPI
+from src.Dash.services.metrics import calculate_metrics_frame
 from src.Dash.services.graph import plotting_engine, blank_fig
 from src.Dash.components.cagr_risk_table import make_cagr_risk_table
 
@@ -185,7 +186,8 @@ def update_risk_table(series):
 
     normalised_data, reference_series, number_month = api.get_weighted_series(series)
 
-    cagr, risk = api.calc_CAGR(normalised_data, number_month)
+    metrics = calculate_metrics_frame(normalised_data)
+    cagr, risk = metrics.loc["cagr"], metrics.loc["risk"]
     table_header = ["CAGR", "Risk"]
     table_data = [[cagr[series], risk[series]]]
     return create_risk_table(table_header, table_data)
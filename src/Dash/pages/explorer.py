@@ -16,6 +16,7 @@ from flask import current_app
 from dash.exceptions import PreventUpdate
 from dash_iconify import DashIconify
 from src.Dash.services.calculation import LocalAPI
+from src.Dash.services.metrics import calculate_metrics_frame
 from src.Dash.services.graph import plotting_engine, blank_fig
 from src.Dash.components.cagr_risk_table import make_cagr_risk_table
 
@@ -59,6 +60,7 @@ def full_layout():
                                 id="dispersion_plot",
                                 figure=blank_fig(),
                             ),
+                            dcc.Store(id="dispersion_density", data=False),
                             dmc.Text(
                                 dcc.Markdown(
                                     id="color_mapping_age", dangerously_allow_html=True
@@ -69,6 +71,31 @@ def full_layout():
                                 "*Reference Index RI stands for S&P500 measured by SPY ETF",
                                 size="sm",
                             ),
+                            dmc.Group(
+                                [
+                                    dmc.NumberInput(
+                                        label="CAGR",
+                                        value=10,
+                                        step=0.5,
+                                        suffix=" %",
+                                        style={"width": 150},
+                                        id="search_cagr",
+                                    ),
+                                    dmc.NumberInput(
+                                        label="Risk",
+                                        value=30,
+                                        step=0.5,
+                                        suffix=" %",
+                                        style={"width": 150},
+                                        id="search_risk",
+                                    ),
+                                    dmc.Button(
+                                        "Find nearest portfolios", id="search_nearest"
+                                    ),
+                                ],
+                                align="flex-end",
+                            ),
+                            html.Div(children=[], id="nearest_portfolios"),
                         ],
                     ),
                     dmc.Paper(
@@ -102,22 +129,108 @@ def full_layout():
 @cache.cached(timeout=None, key_prefix="dispersion_graph_figure")
 def function_process():
     data = api.get_dispersion_data()
-    figure, age_categories = plotter.make_dispersion_plot(data)
+    figure, age_categories = plotter.make_dispersion_plot(
+        data, api.get_pareto_frontier()
+    )
     return figure, age_categories
 
 
 @callback(
     Output("dispersion_plot", "figure"),
     Output("color_mapping_age", "children"),
+    Output("dispersion_density", "data"),
     Input("url", "pathname"),
 )
 def init_graph(path):
     if path == current_app.config["URL_EXPLORER"]:
         figure, age_categories = function_process()
-        return figure, get_color_scale(age_categories)
+        density = bool(figure.layout.meta and figure.layout.meta.get("density"))
+        return figure, get_color_scale(age_categories), density
     raise PreventUpdate
 
 
+def get_zoom_range(relayout_data, axis):
+    if f"{axis}.range[0]" in relayout_data:
+        return [relayout_data[f"{axis}.range[0]"], relayout_data[f"{axis}.range[1]"]]
+    return relayout_data.get(f"{axis}.range")
+
+
+@callback(
+    Output("dispersion_plot", "figure", allow_duplicate=True),
+    Input("dispersion_plot", "relayoutData"),
+    State("dispersion_density", "data"),
+    prevent_initial_call=True,
+)
+def zoom_density(relayout_data, density):
+    # Only density plots load the single portfolios of the zoom window
+    if not density or not relayout_data:
+        raise PreventUpdate
+    plotter.update_config()
+    configuration = plotter.cofiguration.get("dispersion")
+    x_range = get_zoom_range(relayout_data, "xaxis")
+    y_range = get_zoom_range(relayout_data, "yaxis")
+    autorange = relayout_data.get("xaxis.autorange") or relayout_data.get(
+        "yaxis.autorange"
+    )
+    if x_range is None and y_range is None:
+        # Selections, drag mode changes and resizes keep the loaded markers
+        if not autorange:
+            raise PreventUpdate
+        # Zoomed out again, the whole universe is too large for single markers
+        limit = 0
+    else:
+        limit = configuration.get("max_points", 5000)
+    data = api.get_dispersion_window(
+        configuration.get("x_value", "Risk"),
+        x_range,
+        configuration.get("y_value", "CAGR"),
+        y_range,
+        limit,
+    )
+    return plotter.make_zoom_patch(data)
+
+
+@callback(
+    Output("nearest_portfolios", "children"),
+    Input("search_nearest", "n_clicks"),
+    State("search_cagr", "value"),
+    State("search_risk", "value"),
+    prevent_initial_call=True,
+)
+def search_nearest(n_clicks, cagr, risk):
+    if cagr is None or risk is None:
+        raise PreventUpdate
+    data = api.nearest(cagr, risk, k=10)
+    align_style = {"text-align": "center"}
+    header = dmc.TableTr(
+        [dmc.TableTh(column, style=align_style) for column in data.columns]
+    )
+    rows = [
+        dmc.TableTr(
+            [
+                dmc.TableTd(
+                    dmc.Anchor(
+                        series,
+                        href=current_app.config["URL_COMPOSITION"]
+                        + f"?series={series}",
+                        refresh=True,
+                    )
+                ),
+                dmc.TableTd(f"{cagr:.2f}%", style=align_style),
+                dmc.TableTd(f"{risk:.2f}%", style=align_style),
+                dmc.TableTd(age, style=align_style),
+            ]
+        )
+        for series, cagr, risk, age in data.iter_rows()
+    ]
+    return dmc.Table(
+        children=[dmc.TableThead(header), dmc.TableTbody(rows)],
+        withRowBorders=True,
+        withTableBorder=True,
+        withColumnBorders=True,
+    )
+
+
 @callback(
     [
         Output("performance_plot", "figure", allow_duplicate=True),
@@ -137,8 +250,13 @@ def display_click_data(selectedData):
         selected_series
     )
 
-    cagr, risk = api.calc_CAGR(normalised_data, number_month)
-    figure = plotter.make_performance_plot(normalised_data, selected_series)
+    metrics = calculate_metrics_frame(normalised_data)
+    cagr, risk = metrics.loc["cagr"], metrics.loc["risk"]
+    windows = api.cofiguration.get("performance", {}).get("rolling_windows", [])
+    rolling = api.get_rolling_metrics(
+        selected_series, normalised_data[selected_series].to_numpy(), windows
+    )
+    figure = plotter.make_performance_plot(normalised_data, selected_series, rolling)
 
     if figure == "error":
         message = dmc.Notification(
@@ -1,6 +1,5 @@
 import dash_mantine_components as dmc
 import dash
-import os
 import uuid
 import base64
 from io import BytesIO
@@ -16,8 +15,6 @@ from dash import (
     ctx,
     ALL,
 )
-from decimal import Decimal, getcontext
-import pandas as pd
 import numpy as np
 import decimal
 import time
@@ -26,7 +23,16 @@ from flask import current_app
 from dash.exceptions import PreventUpdate
 from flask import session, redirect
 from src.Dash.services.calculation import CalculateCombinations
+from src.Dash.services.calibration import (
+    Calibration,
+    build_curve_store,
+    count_valid_weights,
+    update_portfolios,
+)
+from src.Dash.services.checkpoint import CalibrationCheckpoint
+from src.Dash.services.metrics import PortfolioState
 from src.Dash.services.graph import plotting_engine
+from src.Dash.services.result_writer import BACKENDS, ResultWriter, read_results
 from src.Dash.utils.functions import get_icon
 from src.Dash.components.checklist import create_check_list
 
@@ -50,46 +56,34 @@ import numpy as np
 register_page(__name__, path=current_app.config["URL_SETTINGS"])
 page_name = "settings"
 
-
-def get_valid_weights(
-    partitions, increment, total=1.0, precision=8, tolerance=1e-2, get_weights=False
-):
-    getcontext().prec = precision  # Set precision for Decimal operations
-
-    increment = Decimal(str(increment))
-    total = Decimal(str(total))
-    tolerance = Decimal(str(tolerance))
-    # Generate all possible weights with the given increment
-    weights = [i * increment for i in range(int((total / increment)) + 1)]
-
-    # Exclude combinations where one weight is 100% and find valid combinations
-    valid_weights = [
-        comb  # Sort to treat different orders as the same combination
-        for comb in itertools.product(weights, repeat=partitions)
-        if abs(sum(comb) - total) <= tolerance
-        and sum(weight > Decimal("0") for weight in comb) == partitions
-    ]
-
-    if get_weights:
-        return valid_weights
-    return len(valid_weights)
+calibration_workers = current_app.config["CALIBRATION_WORKERS"]
+calibration_shard_size = current_app.config["CALIBRATION_SHARD_SIZE"]
+calibration_batch_size = current_app.config["CALIBRATION_BATCH_SIZE"]
+calibration_result_format = current_app.config["CALIBRATION_RESULT_FORMAT"]
+calibration_top_x_keys = current_app.config["CALIBRATION_TOP_X_KEYS"]
+calibration_checkpoint_interval = current_app.config["CALIBRATION_CHECKPOINT_INTERVAL"]
+calibration_curve_store = current_app.config["CALIBRATION_CURVE_STORE"]
+calibration_cache_budget = (
+    current_app.config["CALIBRATION_NORMALISATION_CACHE_MB"] * 1024 * 1024
+)
 
 
 def get_number_of_portfolios(column_names, partitions, interval_increment):
-    # Calculate all unique combinations of these elements of length 'partitions'
+    # Every combination of 'partiton' columns has the same number of valid weight distributions
     number_portfolios = 0
-    # Calculate the number of valid weight distributions for each combination
-    for partiton in range(0, partitions):
-        partiton += 1
-        total_combinations = list(itertools.combinations(column_names, partiton))
-        partitions_per_combination = get_valid_weights(
+    for partiton in range(1, (partitions or 0) + 1):
+        number_portfolios += comb(len(column_names), partiton) * count_valid_weights(
             partitions=partiton, increment=interval_increment
         )
-        number_portfolios += len(total_combinations) * partitions_per_combination
 
     return number_portfolios
 
 
+def get_series_columns():
+    # The price store is revalidated against the Series.csv ETag on every read
+    return list(api.load_prices().columns)
+
+
 def precompute_weight_combinations(max_items, partition):
     """Precompute all valid weight combinations for portfolios of sizes 1 to max_items."""
     weight_combinations = {}
@@ -210,11 +204,24 @@ def full_layout():
                                         id="top_x",
                                     ),
                                     dmc.Button("Run calibration", id="run_calibration"),
+                                    dmc.Button(
+                                        "Resume calibration", id="resume_calibration"
+                                    ),
+                                    dmc.Button(
+                                        "Update with new months",
+                                        id="update_calibration",
+                                    ),
                                     dmc.Button(
                                         "Cancle Calibration",
                                         id="cancle_calibration",
                                         disabled=True,
                                     ),
+                                    dmc.Button(
+                                        "Download CSV",
+                                        id="download_result_csv",
+                                        variant="outline",
+                                    ),
+                                    dcc.Download(id="result_csv_download"),
                                 ]
                             ),
                             dmc.Space(h=20),
@@ -312,8 +319,7 @@ def upload_upload(trigger, content, name, socket_id):
     Input("step_size", "value"),
 )
 def update_total(number_partitions, interval_increment):
-    df = api.get_series_data()
-    column_names = df.columns
+    column_names = get_series_columns()
     column_names = column_names[1:]
     number = get_number_of_portfolios(
         column_names, number_partitions, interval_increment
@@ -321,6 +327,18 @@ def update_total(number_partitions, interval_increment):
     return f"The total number of portfolios is: {number}"
 
 
+@callback(
+    Output("result_csv_download", "data"),
+    Input("download_result_csv", "n_clicks"),
+    prevent_initial_call=True,
+)
+def download_result_csv(n_clicks):
+    # The universe is stored columnar, admins get it in the known csv layout
+    current_directory = Path.cwd() / "src/Dash/data"
+    path = api.export_dispersion_csv(current_directory / "new_result_export")
+    return dcc.send_file(path, filename="new_result.csv")
+
+
 def first_non_null_index(col):
     # Use `arg_true` on the `is_not_null` mask to find all non-null indices, then take the first
     indices = col.is_not_null().arg_true()
@@ -329,7 +347,11 @@ def first_non_null_index(col):
 
 @app.long_callback(
     output=Output("calculation_time", "children"),
-    inputs=Input("run_calibration", "n_clicks"),
+    inputs=[
+        Input("run_calibration", "n_clicks"),
+        Input("resume_calibration", "n_clicks"),
+        Input("update_calibration", "n_clicks"),
+    ],
     state=[
         State("step_size", "value"),
         State("partitions", "value"),
@@ -337,6 +359,8 @@ def first_non_null_index(col):
     ],
     running=[
         (Output("run_calibration", "disabled"), True, False),
+        (Output("resume_calibration", "disabled"), True, False),
+        (Output("update_calibration", "disabled"), True, False),
         (Output("cancle_calibration", "disabled"), False, True),
     ],
     cancel=[Input("cancle_calibration", "n_clicks")],
@@ -344,112 +368,152 @@ def first_non_null_index(col):
     progress_default=(0, f"{0}%"),
     interval=100,
 )
-def callback(set_progress, n_clicks, interval_size, partitions, top_x):
+def callback(
+    set_progress,
+    n_clicks,
+    resume_clicks,
+    update_clicks,
+    interval_size,
+    partitions,
+    top_x,
+):
     if ctx.triggered_id is None:
         raise PreventUpdate
 
     start_time = time.time()
     df = api.get_series_data()
+    current_directory = Path.cwd() / "src/Dash/data"
+
+    if ctx.triggered_id == "update_calibration":
+        # Only append the new months of Series.csv to the stored portfolios
+        s3file, result_format = api.get_result_file()
+        columns = read_results(BytesIO(s3file.read()), result_format)
+        if any(column not in columns for column in PortfolioState.COLUMNS):
+            return "The stored portfolios have no running state, please run the calibration."
+        try:
+            updated_columns = update_portfolios(
+                df,
+                columns["combination"],
+                columns["weights"],
+                columns,
+                cache_budget=calibration_cache_budget,
+            )
+        except ValueError as e:
+            return str(e)
+        with ResultWriter(
+            current_directory / "new_result",
+            backend=calibration_result_format,
+            batch_size=calibration_batch_size,
+        ) as writer:
+            writer.write_rows(
+                name=columns["name"],
+                combination=columns["combination"],
+                weights=columns["weights"],
+                **updated_columns,
+            )
+        # A top X result only holds the portfolios selected by the last run, the
+        # others are not stored and can not be updated
+        selected = bool(top_x) and len(columns["name"]) - 1 <= top_x
+        uploads = [writer.path]
+        if calibration_curve_store and selected:
+            curve_path = current_directory / api.curve_file
+            build_curve_store(
+                df,
+                {
+                    "name": columns["name"][1:],
+                    "combination": columns["combination"][1:],
+                    "weights": columns["weights"][1:],
+                },
+            ).write_ipc(curve_path)
+            uploads.append(curve_path)
+        api.upload_files_to_s3(uploads, "data")
+        cache.delete("dispersion_graph_figure")
+        message = f"Finished updating the protfolios. It took {round(time.time() - start_time, 2)}s"
+        if selected:
+            message += (
+                ". The top X portfolios are still the ones selected by the last "
+                "calibration, the new months can change which are the best: run the "
+                "calibration to select them again."
+            )
+        return message
+
     # First remove the date column from the list
     column_names = df.columns
     column_names = column_names[2:]
 
-    current_directory = Path.cwd() / "src/Dash/data"
-    file_name = current_directory / "new_result.csv"
-    filtered_path = current_directory / "check.csv"
-    # Check if the file exists
-    if os.path.exists(file_name):
-        # Delete the file
-        os.remove(file_name)
+    calibration = Calibration(
+        df,
+        column_names,
+        partitions,
+        interval_size,
+        top_x=top_x,
+        top_x_keys=calibration_top_x_keys,
+        workers=calibration_workers,
+        shard_size=calibration_shard_size,
+        cache_budget=calibration_cache_budget,
+    )
+    # The checkpoint is kept in S3 as well, a restart of the dyno wipes its disk
+    checkpoint = CalibrationCheckpoint(
+        current_directory / "new_result.checkpoint.json",
+        f"{calibration.fingerprint()}-{calibration_result_format}",
+        interval=calibration_checkpoint_interval,
+        bucket=current_app.config["S3_CLIENT"].Bucket(current_app.config["S3_BUCKET"]),
+        key="data/new_result.checkpoint.json",
+    )
+
+    # Without a top X limit the written rows are the progress, only CSV files can be
+    # continued and only as long as the local partial file is there
+    resumable = bool(top_x) or BACKENDS[calibration_result_format].supports_resume
+    progress_note = ""
+    if not resumable:
+        progress_note = " (this run can not be resumed)"
+    elif not top_x:
+        progress_note = " (this run can only be resumed until the app restarts)"
+
+    # Resuming continues from the last checkpoint of a run with the same data and settings
+    state = None
+    if ctx.triggered_id == "resume_calibration":
+        if not resumable:
+            return (
+                f"Calibrations without a top X limit can not be resumed with the "
+                f"{calibration_result_format} result format, please run the calibration."
+            )
+        state = checkpoint.load()
+        if state is None:
+            return (
+                "There is no checkpoint for these settings, please run the calibration."
+            )
+        set_progress((state["percentage"], f"{state['percentage']}%"))
     else:
-        pass
-    total_number = get_number_of_portfolios(column_names, partitions, interval_size)
-
-    # Iterate over each combination and preccacluate the valid weights, exclude the first value which is RI
-    index = 1
-    percentage = 0
-    header_written = False
-
-    # Calculate RI
-    df["RI"] = pd.to_numeric(df["RI"], errors="coerce")  # Ensure RI is numeric
-    normalised_df = df[["RI"]].dropna()
-    normalised_df["sum"] = (normalised_df["RI"] / normalised_df["RI"].iloc[0]) * 100
-
-    cagr, risk, age = api.calc_metrics_pandas(normalised_df["sum"])
-    combination_params = {
-        "name": f"RI",
-        "combination": str(("RI",)),
-        "weights": str(
-            [
-                1.0,
-            ]
-        ),
-        "cagr": cagr,
-        "risk": risk,
-        "age": age,
-    }
-    combination_params_df = pd.DataFrame([combination_params])
+        checkpoint.clear()
+        set_progress((0, f"0%{progress_note}"))
+
     try:
-        with open(file_name, "x") as f:
-            combination_params_df.to_csv(f, index=False)
-    except FileExistsError:
-        # File already exists, append without header
-        with open(file_name, "a") as f:
-            combination_params_df.to_csv(f, index=False, header=False)
-
-    for partition in range(1, partitions + 1):
-        for combination in itertools.combinations(column_names, partition):
-            pre_computed_weights = get_valid_weights(
-                partition, interval_size, get_weights=True
-            )
-            # Filter non-null values for the combination of columns
-            filtered_df = df.dropna(subset=combination)
-
-            # Normalize the columns
-            for column in combination:
-                filtered_df[column] = (
-                    filtered_df[column] / filtered_df[column].iloc[0]
-                ) * 100
-
-            for weight_comb in pre_computed_weights:
-                # Calcuclate Portfolio
-                weighted_df = filtered_df.copy()
-                for i, column in enumerate(combination):
-                    weighted_df[column] = weighted_df[column] * float(weight_comb[i])
-
-                weighted_df["sum"] = weighted_df[list(combination)].sum(axis=1)
-
-                cagr, risk, age = api.calc_metrics_pandas(weighted_df["sum"])
-
-                combination_params = {
-                    "name": f"x{index}",
-                    "combination": str(combination),
-                    "weights": str([float(number) for number in weight_comb]),
-                    "cagr": cagr,
-                    "risk": risk,
-                    "age": age,
-                }
-
-                combination_params_df = pd.DataFrame([combination_params])
-                try:
-                    with open(file_name, "x") as f:
-                        combination_params_df.to_csv(f, index=False)
-
-                except FileExistsError:
-                    # File already exists, append without header
-                    with open(file_name, "a") as f:
-                        combination_params_df.to_csv(f, index=False, header=False)
-
-                new_percentage = int((index - 1) / total_number * 100)
-                if new_percentage != percentage:
-                    percentage = new_percentage
-                    set_progress((percentage, f"{percentage}%"))
-
-                index += 1
-
-        # total_df = total_df.sort("cagr", descending=True).head(top_x)
-        # total_df.write_csv(file_name)
-    api.upload_files_to_s3([file_name], "data")
+        writer = ResultWriter(
+            current_directory / "new_result",
+            backend=calibration_result_format,
+            batch_size=calibration_batch_size,
+            resume_offset=state["writer_offset"] if state else None,
+            keep_partial=True,
+        )
+    except FileNotFoundError:
+        # Only the checkpoint survived a restart, not the rows written so far
+        checkpoint.clear()
+        return "The partial result of this run is gone, please run the calibration."
+    curve_path = None
+    if calibration_curve_store and top_x:
+        curve_path = current_directory / api.curve_file
+    result_path = calibration.run(
+        writer,
+        set_progress=lambda percentage: set_progress(
+            (percentage, f"{percentage}%{progress_note}")
+        ),
+        checkpoint=checkpoint,
+        state=state,
+        curve_path=curve_path,
+    )
+    checkpoint.clear()
+    api.upload_files_to_s3([result_path] + ([curve_path] if curve_path else []), "data")
 
     cache.delete("dispersion_graph_figure")
     return f"Finished calculating the protfolios. It took {round(time.time() - start_time, 2)}s"
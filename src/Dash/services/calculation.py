@@ -1,16 +1,29 @@
+import os
 import json
+import shutil
 import decimal
-import ast
-import logging
+import tempfile
 from io import BytesIO
 
 import polars as pl
+import pyarrow as pa
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from itertools import combinations, product
+from itertools import product
 from .mixins.S3mixin import S3Mixin
+from .dataset import (
+    CurveStore,
+    DatasetCache,
+    PriceStore,
+    SharedDatasets,
+    Universe,
+    read_ipc_table,
+)
+from .metrics import rolling_metrics
+from .result_writer import BACKENDS, ResultWriter, read_results, write_ipc
 from flask import current_app
+from botocore.exceptions import ClientError
 
 cache = current_app.cache
 
@@ -18,14 +31,46 @@ cache = current_app.cache
 context = decimal.getcontext()
 context.rounding = decimal.ROUND_HALF_UP
 
+# Column names of the calibration result file and their names in the dashboard
+DISPERSION_COLUMNS = {
+    "name": "Series",
+    "combination": "Combination",
+    "weights": "Weights",
+    "cagr": "CAGR",
+    "risk": "Risk",
+    "age": "Age",
+    "volatility": "Volatility",
+    "max_drawdown": "Max Drawdown",
+    "drawdown_duration": "Drawdown Duration",
+    "sharpe": "Sharpe",
+    "sortino": "Sortino",
+    "calmar": "Calmar",
+    "best_12m": "Best 12M",
+    "worst_12m": "Worst 12M",
+}
+
+# Parsed data files, shared by all LocalAPI instances of the process
+datasets = DatasetCache()
+# and by all workers, if a shared memory directory is configured
+shared_datasets = None
+if current_app.config["SHARED_DATASET_DIRECTORY"]:
+    shared_datasets = SharedDatasets(current_app.config["SHARED_DATASET_DIRECTORY"])
+
 
 class LocalAPI(S3Mixin):
 
     def __init__(self) -> None:
         self.working_directory = Path.cwd()
         self.data_folder = "src/Dash/data"
-        self.dispersion_file = "new_result.csv"
+        # The calibration writes the universe as new_result.parquet, .arrow or .csv
+        self.dispersion_format = current_app.config["CALIBRATION_RESULT_FORMAT"]
+        self.dispersion_file = "new_result" + BACKENDS[self.dispersion_format].suffix
+        # Buckets calibrated before the columnar formats only hold the CSV file
+        self.legacy_dispersion_file = "new_result.csv"
         self.series_file = "Series.csv"
+        # Curves of the top X portfolios, written by the calibration
+        self.curve_store = current_app.config["CALIBRATION_CURVE_STORE"]
+        self.curve_file = "curves.arrow"
 
         self.dispersion_path = Path.joinpath(
             self.working_directory, self.data_folder, self.dispersion_file
@@ -33,6 +78,12 @@ class LocalAPI(S3Mixin):
         self.series_path = Path.joinpath(
             self.working_directory, self.data_folder, self.series_file
         )
+        # Local Arrow IPC copy of the universe, memory mapped instead of read
+        self.memory_map_dispersion = current_app.config["DISPERSION_MEMORY_MAP"]
+        self.dispersion_ipc_path = Path(
+            current_app.config["DISPERSION_MEMORY_MAP_DIRECTORY"], "new_result.arrow"
+        )
+        self.curve_ipc_path = self.dispersion_ipc_path.with_name(self.curve_file)
 
         self.config_folder = "src/Dash/config"
         self.graph_file = "graphs.json"
@@ -45,270 +96,341 @@ class LocalAPI(S3Mixin):
         data = json.load(f)
         self.cofiguration = data
 
-    def load_dispersion_data(self):
+    def load_dispersion_data(self, columns=None):
+        """
+        Load the portfolio universe, optionally only the given (dashboard) columns.
+
+        The parsed file is kept in the process wide dataset cache and only downloaded
+        again when its ETag changed. Parquet and Arrow files have Combination and
+        Weights as list columns, CSV files hold them as python literals.
+        """
+        file_columns = list(DISPERSION_COLUMNS)
+        if columns is not None:
+            file_columns = [
+                name for name, column in DISPERSION_COLUMNS.items() if column in columns
+            ]
+
+        df = self.load_universe().frame
+        # Universes of older calibrations lack the extended metrics
+        return df.select(
+            [
+                DISPERSION_COLUMNS[name]
+                for name in file_columns
+                if DISPERSION_COLUMNS[name] in df.columns
+            ]
+        )
+
+    def load_universe(self):
+        """
+        The universe with its series index. Both are built once per version of the
+        file and rebuilt when a new one is uploaded.
+        """
+        _, universe = self.load_universe_version()
+        return universe
+
+    def load_universe_version(self):
+        """
+        The version and the universe of the configured result file, or of the legacy
+        new_result.csv as long as no calibration wrote the configured one.
+        """
+        try:
+            return self.load_universe_file(self.dispersion_file, self.dispersion_format)
+        except ClientError as e:
+            if (
+                e.response["Error"]["Code"] != "NoSuchKey"
+                or self.dispersion_file == self.legacy_dispersion_file
+            ):
+                raise
+        return self.load_universe_file(self.legacy_dispersion_file, "csv")
+
+    def get_result_file(self):
+        """
+        The body and the format of the stored result file, resolved like
+        load_universe_version.
+        """
+        try:
+            return (
+                self.get_data_file("data/" + self.dispersion_file),
+                self.dispersion_format,
+            )
+        except ClientError as e:
+            if (
+                e.response["Error"]["Code"] != "NoSuchKey"
+                or self.dispersion_file == self.legacy_dispersion_file
+            ):
+                raise
+        return self.get_data_file("data/" + self.legacy_dispersion_file), "csv"
+
+    def load_universe_file(self, file_name, file_format):
+        return datasets.get(
+            "data/" + file_name,
+            self.get_changed_data_file,
+            lambda s3file, version, fetched_at: self.parse_dispersion_data(
+                s3file, version, fetched_at, file_format
+            ),
+        )
+
+    def share_dataset(self, name, version, dataset_class, build, s3file, fetched_at):
+        """Build a dataset, or attach to the copy another worker published."""
+        if shared_datasets is None:
+            return build()
+        try:
+            return shared_datasets.get(name, version, dataset_class, build, fetched_at)
+        finally:
+            s3file.close()
+
+    def parse_dispersion_data(self, s3file, version, fetched_at=None, file_format=None):
+        file_format = file_format or self.dispersion_format
+        return self.share_dataset(
+            "universe",
+            version,
+            Universe,
+            lambda: Universe.from_frame(
+                self.read_dispersion_frame(s3file, file_format)
+            ),
+            s3file,
+            fetched_at,
+        )
 
-        s3file = self.get_data_file("data/" + self.dispersion_file)
-        s3_file_content = s3file.read()
+    def download_data_file(self, s3file, directory):
+        """Stream a data file into a new file in directory and return its path."""
+        directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as download:
+            shutil.copyfileobj(s3file, download, 1024 * 1024)
+        return download.name
+
+    def store_dispersion_ipc(self, s3file, file_format):
+        """
+        Stream the universe to local disk and convert it to an Arrow IPC file, without
+        holding the whole file in memory.
+        """
+        download = self.download_data_file(s3file, self.dispersion_ipc_path.parent)
+        ipc_path = download
+        if file_format != "arrow":
+            ipc_path = download + ".arrow"
+            try:
+                write_ipc(download, ipc_path, file_format)
+            finally:
+                os.unlink(download)
+            # The allocator keeps the pages of the converted batches otherwise
+            pa.default_memory_pool().release_unused()
+        # Workers with a map of the previous file keep reading it
+        os.replace(ipc_path, self.dispersion_ipc_path)
+        return self.dispersion_ipc_path
+
+    def read_dispersion_frame(self, s3file, file_format):
+        """
+        The result file as a polars frame, or as the Arrow table of the memory mapped
+        copy. Universe.from_frame only converts the columns it keeps of the table.
+        """
+        if self.memory_map_dispersion:
+            table = read_ipc_table(self.store_dispersion_ipc(s3file, file_format))
+            return self.select_dispersion_columns(table)
         # Convert bytes to BytesIO for compatibility with Polars
-        file_like_object = BytesIO(s3_file_content)
-        df = pl.read_csv(
-            file_like_object,
-            separator=",",
-            low_memory=True,
-            new_columns=["Series", "Combination", "Weights", "CAGR", "Risk", "Age"],
+        file_like_object = BytesIO(s3file.read())
+        if file_format == "parquet":
+            df = pl.read_parquet(file_like_object)
+        elif file_format == "arrow":
+            df = pl.read_ipc(file_like_object)
+        else:
+            df = pl.read_csv(file_like_object, separator=",", low_memory=True)
+        return self.select_dispersion_columns(df)
+
+    def select_dispersion_columns(self, df):
+        """
+        Keep the dashboard columns of a result file (a polars frame or an Arrow table),
+        named as in the dashboard.
+        """
+        is_table = isinstance(df, pa.Table)
+        names = df.column_names if is_table else df.columns
+        columns = {
+            name: column for name, column in DISPERSION_COLUMNS.items() if name in names
+        }
+        if is_table:
+            return df.select(list(columns)).rename_columns(list(columns.values()))
+        return df.rename(columns).select(list(columns.values()))
+
+    def get_dispersion_data(self):
+        self.update_config()
+        configuration = self.cofiguration.get("dispersion")
+        # The axes of the dispersion plot can show any of the stored metrics
+        df = self.load_dispersion_data(
+            [
+                "Series",
+                "CAGR",
+                "Risk",
+                "Age",
+                configuration.get("x_value", "Risk"),
+                configuration.get("y_value", "CAGR"),
+            ]
         )
-        logging.error("Finished")
         return df
 
-    def get_dispersion_data(self):
-        df = self.load_dispersion_data()
-        df = df.select(["Series", "CAGR", "Risk", "Age"])
+    def get_pareto_frontier(self):
+        """Rows of the dispersion data on the Pareto frontier, ordered by risk."""
+        return self.load_universe().frontier
+
+    def nearest(self, cagr, risk, k=10):
+        """The k portfolios closest to the given CAGR and risk, closest first."""
+        universe = self.load_universe()
+        rows = universe.grid.nearest(risk, cagr, k)
+        return universe.frame[rows].select(["Series", "CAGR", "Risk", "Age"])
+
+    def get_dispersion_window(self, x_column, x_range, y_column, y_range, limit):
+        """
+        Portfolios (without RI) inside a zoom window, a range of None is unbounded.
+        More than limit portfolios are thinned out evenly.
+        """
+        df = self.get_dispersion_data().filter(pl.col("Series") != "RI")
+        for column, value_range in [(x_column, x_range), (y_column, y_range)]:
+            if value_range is not None:
+                df = df.filter(pl.col(column).is_between(*sorted(value_range)))
+        if len(df) > limit:
+            df = df.gather_every(-(-len(df) // limit)) if limit else df.clear()
         return df
 
     def get_series_combination_weights(self, series):
-        df = self.load_dispersion_data()
-        selected_row = df.filter(pl.col("Series") == series)
-        combination = list(ast.literal_eval(selected_row["Combination"][0]))
-        weights = list(ast.literal_eval(selected_row["Weights"][0]))
-        weights = [float(weight) for weight in weights]
-        return combination, weights
+        return self.load_universe().combination_weights(series)
+
+    def export_dispersion_csv(self, path):
+        """Write the universe as the legacy new_result.csv, e.g. for the admins."""
+        s3file, file_format = self.get_result_file()
+        columns = read_results(BytesIO(s3file.read()), file_format)
+        with ResultWriter(path, backend="csv", columns=list(columns)) as writer:
+            writer.write_rows(**columns)
+        return writer.path
 
     def get_weighted_series(self, series):
         self.update_config()
         configuration = self.cofiguration.get("performance")
         reference_series = configuration.get("reference_series", "RI")
         combination, weights = self.get_series_combination_weights(series)
-        df = pd.read_csv(
-            self.get_data_file("data/" + self.series_file),
-            sep=",",
-            header=0,
-            decimal=".",
-        )
-
-        df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%Y")
-        df.set_index("Date", inplace=True)
-        df = df.sort_index()
-        highest_valid_index = max(df[col].first_valid_index() for col in combination)
-        normalized_series = pd.DataFrame(
+        prices = self.load_prices()
+        curve = self.get_stored_curve(series, combination, weights, prices)
+        if curve is None:
+            start, combined_series = prices.weighted_series(combination, weights)
+            rows = np.arange(start, len(prices.dates))
+        else:
+            # The calibration skips the months a member has no price
+            rows = np.flatnonzero(~np.isnan(curve))
+            start, combined_series = rows[0], curve[rows].astype(np.float64)
+        data = pd.DataFrame(
             {
-                col: df[col]
-                .loc[df.index >= highest_valid_index]
-                .div(df[col].loc[highest_valid_index])
-                * 100
-                * weight
-                for col, weight in zip(combination, weights)
-                if weight > 0
-            }
-        )
-        combined_series = normalized_series.sum(axis=1)
-        data = pd.concat(
-            [
-                df.loc[normalized_series.index, reference_series]
-                / df.loc[normalized_series.index, reference_series].iloc[0]
-                * 100,
-                combined_series,
-            ],
-            axis=1,
+                reference_series: prices.normalised(reference_series, start)[
+                    rows - start
+                ],
+                series: combined_series,
+            },
+            index=prices.index()[rows],
         )
-        data.columns = [reference_series, series]
-        data = data.sort_index()
         return data, reference_series, len(data)
 
-    def get_series_data(self, series=False, polar=False):
-        df = pd.read_csv(
-            self.get_data_file("data/" + self.series_file),
-            sep=",",
-            header=0,
-            decimal=".",
+    def get_stored_curve(self, series, combination, weights, prices):
+        """The curve of a portfolio from the curve store, None if it is not stored."""
+        if not self.curve_store:
+            return None
+        try:
+            _, store = datasets.get(
+                "data/" + self.curve_file,
+                self.get_changed_data_file,
+                self.parse_curve_store,
+            )
+        except ClientError:
+            # No calibration wrote a curve store yet
+            return None
+        return store.curve(series, combination, weights, prices.dates)
+
+    def parse_curve_store(self, s3file, version, fetched_at=None):
+        return self.share_dataset(
+            "curves",
+            version,
+            CurveStore,
+            lambda: CurveStore.from_ipc(
+                pa.memory_map(str(self.store_curve_ipc(s3file)))
+            ),
+            s3file,
+            fetched_at,
+        )
+
+    def store_curve_ipc(self, s3file):
+        """Stream the curve store to local disk, to memory map it instead of reading."""
+        download = self.download_data_file(s3file, self.curve_ipc_path.parent)
+        # Workers with a map of the previous file keep reading it
+        os.replace(download, self.curve_ipc_path)
+        return self.curve_ipc_path
+
+    def get_rolling_metrics(self, series, curve, windows):
+        """
+        Rolling CAGR, volatility and drawdown of the curve of a portfolio, as returned
+        by get_weighted_series, for every window in months. Cached per series, window
+        and dataset version.
+        """
+        version = self.get_dataset_version()
+        result = {}
+        for window in windows:
+            key = f"rolling_metrics/{series}/{window}/{version}"
+            metrics = cache.get(key)
+            if metrics is None:
+                metrics = rolling_metrics(curve, window)
+                cache.set(key, metrics)
+            result[window] = metrics
+        return result
+
+    def get_dataset_version(self):
+        """
+        Version of the universe and Series.csv as loaded last, changes when either is
+        uploaded. The files are not revalidated.
+        """
+        universe_version = datasets.version("data/" + self.dispersion_file)
+        if universe_version is None:
+            universe_version = datasets.version("data/" + self.legacy_dispersion_file)
+        prices_version = datasets.version("data/" + self.series_file)
+        return f"{universe_version}/{prices_version}"
+
+    def load_prices(self):
+        """Series.csv as a PriceStore, served from the process wide dataset cache."""
+        _, prices = datasets.get(
+            "data/" + self.series_file,
+            self.get_changed_data_file,
+            self.parse_series_data,
+        )
+        return prices
+
+    def load_series_data(self):
+        """Series.csv indexed by date, in the row order of the file."""
+        return self.load_prices().frame
+
+    def parse_series_data(self, s3file, version, fetched_at=None):
+        return self.share_dataset(
+            "prices",
+            version,
+            PriceStore,
+            lambda: PriceStore.from_frame(self.read_series_frame(s3file)),
+            s3file,
+            fetched_at,
         )
-        if polar:
-            polars_df = pl.from_pandas(df)
-            # columns_to_cast = polars_df.columns[1:]
-            # print(columns_to_cast)
-            # polars_df = polars_df.with_columns(
-            #    [
-            #        pl.col(column).cast(pl.Float64).alias(column)
-            #        for column in columns_to_cast
-            #    ]
-            # )
-            return polars_df
 
+    def read_series_frame(self, s3file):
+        df = pd.read_csv(s3file, sep=",", header=0, decimal=".")
         df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%Y")
         df.set_index("Date", inplace=True)
-
         return df
 
-    def calc_CAGR(self, normalised_data, number_of_month=False):
-        if not number_of_month:
-            number_of_month = len(normalised_data)
-        cagr = (
-            normalised_data.iloc[-1].apply(
-                lambda x: (x / 100) ** (12 / number_of_month) - 1
-            )
-            * 100
-        )
+    def get_series_data(self, series=False, polar=False):
+        # Callers modify the frame, the cached one has to stay untouched
+        df = self.load_series_data().copy()
+        if polar:
+            df = df.reset_index()
+            df["Date"] = df["Date"].dt.strftime("%d/%m/%Y")
+            return pl.from_pandas(df)
 
-        risk = normalised_data / normalised_data.shift()
-        risk = risk[risk < 1.0].count() / number_of_month * 100
-        return cagr, risk
+        return df
 
     def get_series(self, series=False):
-        df = self.load_dispersion_data()
+        df = self.load_dispersion_data(["Series"])
         return df.select("Series").to_series().to_list()
 
 
 class CalculateCombinations(LocalAPI):
-    def calc_metrics_pandas(self, portfolio):
-        # Calculate the number of months
-        number_of_months = len(portfolio)
-
-        # Calculate the CAGR (Compound Annual Growth Rate)
-        temp = portfolio.iloc[-1] / 100
-        cagr = (temp ** (12 / number_of_months) - 1) * 100
-
-        # Calculate the risk
-        risk = portfolio / portfolio.shift(1)
-        risk = risk.dropna()  # Drop NaN values that result from shifting
-        risk_below_one = risk[risk < 1.0]
-        risk_count = len(risk_below_one)
-        risk_percentage = (risk_count / number_of_months) * 100
-
-        return cagr, risk_percentage, number_of_months
-
-    def calc_metrics_polars(self, portfolio):
-        number_of_month = portfolio.height
-        temp = portfolio.select(pl.last("sum")) / 100
-        cagr = temp.item(0, 0) ** (12 / number_of_month) - 1
-        cagr *= 100
-
-        risk = portfolio / portfolio.shift(1)
-        risk = (
-            risk.select("sum")
-            .filter(pl.col("sum").is_not_null())
-            .filter(pl.col("sum") < 1.0)
-            .count()
-            .item(0, 0)
-            / number_of_month
-            * 100
-        )
-        return cagr, risk
-
-    def vec_calc_CAGR(self, normalised_data, number_of_month=None):
-        if number_of_month is None:
-            number_of_month = len(normalised_data)
-        # Convert normalised_data to numpy array for compatibility with np.float
-        normalised_data_np = np.array(normalised_data)
-        # Calculate CAGR using vectorized operations
-        cagr = (normalised_data_np[-1] / 100) ** (12 / number_of_month) - 1
-        cagr *= 100
-        # Calculate risk using vectorized operations and np.less
-        risk = normalised_data_np / np.roll(normalised_data_np, shift=1)
-        risk = np.less(risk, 1.0).sum() / number_of_month * 100
-
-        return cagr, risk
-        # Generate all combinations of time series with different weights using NumPy broadcasting
-
     def generate_weight_combinations(self, column_names, step_size=0.2):
         return product(np.arange(0, 1.01, step_size), repeat=len(column_names))
-
-    def calculate_metrics_vectorized(series):
-        returns = series.pct_change().dropna()
-        CAGR = (series.iloc[-1] / series.iloc[0]) ** (
-            1 / len(series.index.year.unique())
-        ) - 1
-        risk = np.std(returns) * np.sqrt(len(series))
-        return CAGR, risk
-
-    def calc_CAGR_Risk_combinations(self):
-        # Function to calculate CAGR and risk using vectorized operations
-        def calculate_metrics_vectorized(series):
-            returns = series.pct_change().dropna()
-            CAGR = (series.iloc[-1] / series.iloc[0]) ** (
-                1 / len(series.index.year.unique())
-            ) - 1
-            risk = np.std(returns) * np.sqrt(len(series))
-            return CAGR, risk
-
-        df = self.get_series_data()
-        column_names = df.columns
-        column_names = column_names[1:]
-
-        # Set the chunk size
-        chunk_size = 100
-
-        weights_list = product(np.arange(0, 1.01, 0.25), repeat=len(column_names))
-        # Get the total number of combinations
-        total_combinations = len(
-            list(combinations(column_names, r=len(column_names)))
-        ) * 5 ** len(column_names)
-
-        # Counter variable for progress tracking
-        progress_counter = 0
-
-        header_written = False
-        result_csv_path = "/home/simon/Documents/Pure_Inference/Kunden/Andres/dashboard/src/Dash/data/result.csv"
-        index = 1
-
-        # Iterate over combinations of weights
-        for combo_weights in product(np.arange(0, 1.01, 0.2), repeat=len(column_names)):
-            # Check if the weights sum up to 1.0
-            if np.isclose(np.sum(combo_weights), 1.0):
-
-                # Filter only time series with non-zero weights
-                valid_columns = [
-                    col
-                    for col, weight in zip(column_names, combo_weights)
-                    if weight > 0
-                ]
-                valid_weights = [weight for weight in combo_weights if weight > 0]
-                # Find the highest valid index among valid time series
-                highest_valid_index = max(
-                    df[col].first_valid_index() for col in valid_columns
-                )
-                # Normalize each selected time series individually
-                normalized_series = pd.DataFrame(
-                    {
-                        col: df[col]
-                        .loc[df.index >= highest_valid_index]
-                        .div(df[col].loc[highest_valid_index])
-                        * 100
-                        * weight
-                        for col, weight in zip(valid_columns, valid_weights)
-                    }
-                )
-
-                # Sum the normalized and weighted time series to get a single series
-                combined_series = normalized_series.sum(axis=1)
-
-                # Calculate CAGR and risk using vectorized operations
-                cagr, risk = self.vec_calc_CAGR(combined_series)
-
-                # Save combination parameters and metrics in a dictionary
-                combination_params = {
-                    "name": f"x{index}",
-                    "combination": valid_columns,
-                    "weights": valid_weights,
-                    "cagr": cagr,
-                    "risk": risk,
-                }
-
-                # Append the results to the CSV file
-                if not header_written:
-                    combination_params_df = pd.DataFrame([combination_params])
-                    combination_params_df.to_csv(result_csv_path, mode="a", index=False)
-                    header_written = True
-                else:
-                    combination_params_df = pd.DataFrame([combination_params])
-                    combination_params_df.to_csv(
-                        result_csv_path, mode="a", index=False, header=False
-                    )
-
-                # Increment the progress counter
-                progress_counter += 1
-                index += 1
-
-                # Print progress
-                if progress_counter % 100 == 0:
-                    print(
-                        f"Progress: {progress_counter} / {total_combinations} combinations processed"
-                    )
@@ -0,0 +1,654 @@
+import json
+import hashlib
+import heapq
+import itertools
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, getcontext
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from .dataset import CurveStore
+from .metrics import PortfolioState
+
+# Bytes of normalised columns memoized per calibration process
+NORMALISATION_CACHE_BUDGET = 256 * 1024 * 1024
+
+
+def normalise_prices(prices):
+    """Rebase every column of a (months x ETFs) price matrix to 100 at its first row."""
+    return prices / prices[0] * 100
+
+
+class NormalisedColumns:
+    """
+    Price columns rebased to 100 at a start row, memoized per (column, start).
+
+    Combinations share their members, and the common start of a combination is the
+    latest first price of its members, so the same rebased column is needed by many
+    combinations. The vectors are kept in LRU order within budget bytes.
+
+    Only columns without gaps after their first price are memoized. For those the
+    rows dropna keeps for a combination start at the common start, with a gap the
+    rows depend on the other members and the combination is built by dropna.
+    """
+
+    def __init__(self, prices, budget=NORMALISATION_CACHE_BUDGET):
+        self.prices = prices
+        self.budget = budget
+        self.size = 0
+        self.vectors = OrderedDict()
+        self.columns = {}
+
+    def column(self, name):
+        """The prices of a column, its first valid row and whether it has gaps."""
+        if name not in self.columns:
+            values = self.prices[name].to_numpy(dtype=float)
+            valid = ~np.isnan(values)
+            first = int(valid.argmax()) if valid.any() else len(values)
+            self.columns[name] = (values, first, not valid[first:].all())
+        return self.columns[name]
+
+    def normalised(self, name, start):
+        key = (name, start)
+        vector = self.vectors.get(key)
+        if vector is not None:
+            self.vectors.move_to_end(key)
+            return vector
+        values = self.column(name)[0][start:]
+        vector = values / values[0] * 100
+        self.vectors[key] = vector
+        self.size += vector.nbytes
+        while self.size > self.budget and self.vectors:
+            _, evicted = self.vectors.popitem(last=False)
+            self.size -= evicted.nbytes
+        return vector
+
+    def combination(self, combination):
+        """
+        The normalised (months x ETFs) matrix of a combination, the same as
+        normalise_prices of its dropna rows.
+        """
+        columns = [self.column(name) for name in combination]
+        start = max(first for _, first, _ in columns)
+        if any(gaps for _, _, gaps in columns) or start >= len(self.prices):
+            prices = self.prices.dropna(subset=combination)[list(combination)]
+            return normalise_prices(prices.to_numpy(dtype=float))
+        return np.column_stack([self.normalised(name, start) for name in combination])
+
+
+def calibrate_combination(normalised_prices, weights):
+    """
+    Calculate all portfolios of one ETF combination at once.
+
+    normalised_prices is the (months x ETFs) matrix of the combination and weights the
+    (portfolios x ETFs) matrix of valid weight vectors. A single matrix product builds
+    every portfolio value series, which are reduced to their PortfolioState.
+    """
+    curves = normalised_prices @ weights.T
+    return PortfolioState.from_curves(curves)
+
+
+def update_portfolios(
+    prices, combinations, weights, columns, cache_budget=NORMALISATION_CACHE_BUDGET
+):
+    """
+    Append the months Series.csv gained since the calibration to stored portfolios.
+
+    combinations, weights and columns (the metric and state columns) describe the
+    stored portfolios. For every combination the rows of the combination are taken
+    from prices, the first `length` of them are the history the state already
+    covers. Only the new rows are built into portfolio values, so the work is
+    proportional to the new months times the number of portfolios. Returns the
+    updated columns.
+    """
+    normalised = NormalisedColumns(prices, cache_budget)
+    state = PortfolioState.from_columns(columns)
+    groups = {}
+    for row, combination in enumerate(combinations):
+        groups.setdefault(tuple(combination), []).append(row)
+
+    for combination, rows in groups.items():
+        rows = np.array(rows)
+        normalised_prices = normalised.combination(combination)
+        group_weights = np.array([weights[row] for row in rows], dtype=float)
+        group_state = state.select(rows)
+
+        # All portfolios of a combination share its history length
+        length = int(group_state.length[0])
+        if length > len(normalised_prices):
+            raise ValueError(f"Series.csv lost history of {combination}")
+        # The last 12 months of the history for the 12 month returns
+        tail = normalised_prices[max(length - 12, 0) : length] @ group_weights.T
+        if not np.allclose(tail[-1], group_state.last, rtol=1e-9):
+            raise ValueError(
+                f"The history of {combination} changed, run a full calibration"
+            )
+
+        group_state.update(normalised_prices[length:] @ group_weights.T, tail)
+        state.assign(rows, group_state)
+
+    return state.columns()
+
+
+def portfolio_curves(prices, combinations, weights):
+    """
+    Value series of portfolios over all rows of prices as (months x portfolios)
+    matrix, NaN in the months a portfolio is not calculated. The portfolios of a
+    combination share one matrix product.
+    """
+    curves = np.full((len(prices), len(combinations)), np.nan)
+    groups = {}
+    for row, combination in enumerate(combinations):
+        groups.setdefault(tuple(combination), []).append(row)
+
+    for combination, rows in groups.items():
+        combination_prices = prices[list(combination)]
+        valid = combination_prices.notna().all(axis=1).to_numpy()
+        normalised_prices = normalise_prices(
+            combination_prices.to_numpy(dtype=float)[valid]
+        )
+        group_weights = np.array([weights[row] for row in rows], dtype=float)
+        curves[np.ix_(valid, rows)] = normalised_prices @ group_weights.T
+    return curves
+
+
+def build_curve_store(prices, rows):
+    """The curves of the portfolios in the result columns rows as CurveStore."""
+    curves = portfolio_curves(prices, rows["combination"], rows["weights"])
+    # The store is sorted by date like the PriceStore it is looked up with
+    dates = prices.index.values.astype("datetime64[ns]").view(np.int64)
+    order = np.argsort(dates, kind="stable")
+    return CurveStore(
+        dates[order],
+        list(rows["name"]),
+        np.array(
+            [
+                CurveStore.portfolio_key(combination, weights)
+                for combination, weights in zip(rows["combination"], rows["weights"])
+            ],
+            dtype=str,
+        ),
+        np.ascontiguousarray(curves[order].T, dtype=np.float32),
+    )
+
+
+def calibrate_shard(normalised, combinations, weights, top_x=None, min_cagr=-np.inf):
+    """
+    Calculate the result columns of all portfolios for a shard of ETF combinations,
+    with the NormalisedColumns of the prices.
+
+    Returns (positions, columns) per combination, positions are the rows of the
+    weight matrix the columns hold, None for all of them. With top_x only the
+    candidates for the top X are returned: a portfolio with a CAGR below min_cagr or
+    with top_x better portfolios in the same shard can not be selected.
+    """
+    results = [
+        calibrate_combination(normalised.combination(combination), weights).columns()
+        for combination in combinations
+    ]
+    if top_x is None:
+        return [(None, columns) for columns in results]
+
+    cagr = np.concatenate([columns["cagr"] for columns in results])
+    if len(cagr) > top_x:
+        kth = len(cagr) - top_x
+        min_cagr = max(min_cagr, np.partition(cagr, kth)[kth])
+    candidates = []
+    for columns in results:
+        positions = np.flatnonzero(columns["cagr"] >= min_cagr)
+        candidates.append(
+            (positions, {name: values[positions] for name, values in columns.items()})
+        )
+    return candidates
+
+
+def shard_combinations(column_names, partitions, shard_size, start=None):
+    """
+    Split the ETF combinations of the given partitions into shards, in calibration order.
+
+    start is an optional (partition, position) cursor, the combinations before it are
+    skipped when a calibration is resumed.
+    """
+    for partition in partitions:
+        combinations = itertools.combinations(column_names, partition)
+        if start is not None:
+            if partition < start[0]:
+                continue
+            if partition == start[0]:
+                combinations = itertools.islice(combinations, start[1], None)
+        while True:
+            shard = list(itertools.islice(combinations, shard_size))
+            if not shard:
+                break
+            yield partition, shard
+
+
+# Normalised columns of a pool worker, set once per process by the pool initializer
+_worker_normalised = None
+
+
+def _init_worker(prices, cache_budget):
+    global _worker_normalised
+    _worker_normalised = NormalisedColumns(prices, cache_budget)
+
+
+def _calibrate_worker_shard(combinations, weights, top_x, min_cagr):
+    return calibrate_shard(_worker_normalised, combinations, weights, top_x, min_cagr)
+
+
+def run_calibration(
+    prices,
+    shards,
+    weight_matrices,
+    workers=1,
+    cache_budget=NORMALISATION_CACHE_BUDGET,
+    top_x=None,
+    min_cagr=None,
+):
+    """
+    Calculate all shards and yield (partition, combination, (positions, columns)) in
+    shard order, see calibrate_shard.
+
+    With more than one worker the shards are calculated in a process pool. Results
+    are still yielded in submission order, so the portfolio numbering stays the
+    same as in a single process run. Only a bounded number of shards is in flight
+    to keep the memory of pending results small. The pool processes are children of
+    the long callback job, so cancelling the job also stops them.
+
+    Every process memoizes the normalised columns within cache_budget bytes. With
+    top_x the shards are filtered to the candidates for the top X in the workers,
+    min_cagr() is the lowest CAGR a candidate needs when a shard is submitted.
+    """
+
+    def threshold():
+        return -np.inf if min_cagr is None else min_cagr()
+
+    if workers <= 1:
+        normalised = NormalisedColumns(prices, cache_budget)
+        for partition, shard in shards:
+            results = calibrate_shard(
+                normalised, shard, weight_matrices[partition], top_x, threshold()
+            )
+            yield from ((partition, c, r) for c, r in zip(shard, results))
+        return
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(prices, cache_budget)
+    )
+    pending = deque()
+    try:
+        for partition, shard in shards:
+            future = executor.submit(
+                _calibrate_worker_shard,
+                shard,
+                weight_matrices[partition],
+                top_x,
+                threshold(),
+            )
+            pending.append((partition, shard, future))
+            if len(pending) >= workers * 4:
+                yield from _collect_shard(*pending.popleft())
+        while pending:
+            yield from _collect_shard(*pending.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _collect_shard(partition, shard, future):
+    return ((partition, c, r) for c, r in zip(shard, future.result()))
+
+
+class TopKSelector:
+    """
+    Keeps the best k portfolios of the calibration stream in a bounded min-heap.
+
+    Portfolios are ranked by CAGR. Ties are broken by the secondary keys in order,
+    "risk" prefers the lower risk (the portfolio that Pareto-dominates the other)
+    and "age" the longer history. Remaining ties keep the earlier portfolio.
+    """
+
+    KEY_SIGNS = {"risk": -1, "age": 1}
+
+    def __init__(self, k, secondary_keys=("risk",)):
+        self.k = k
+        self.secondary_keys = [key for key in secondary_keys if key]
+        self.heap = []
+
+    def min_cagr(self):
+        """The lowest CAGR a portfolio needs to enter the heap."""
+        if len(self.heap) < self.k:
+            return -np.inf
+        return self.heap[0][0][0]
+
+    def offer(self, first_index, combination, weights, columns, positions=None):
+        """
+        Offer the portfolios of one combination, numbered from first_index. The
+        columns hold the portfolios at positions of the weights, by default all.
+        """
+        cagr = columns["cagr"]
+        if positions is None:
+            positions = np.arange(len(cagr))
+        # Only portfolios at least as good as the current worst can enter the heap
+        candidates = np.flatnonzero(cagr >= self.min_cagr())
+
+        for i in candidates:
+            position = int(positions[i])
+            index = first_index + position
+            key = (float(cagr[i]),)
+            key += tuple(
+                self.KEY_SIGNS[name] * float(columns[name][i])
+                for name in self.secondary_keys
+            )
+            entry = (
+                key + (-index,),
+                index,
+                combination,
+                weights[position],
+                {name: values[i].item() for name, values in columns.items()},
+            )
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, entry)
+            elif entry > self.heap[0]:
+                heapq.heapreplace(self.heap, entry)
+
+    def state(self):
+        """Return the heap as JSON serialisable lists for a checkpoint."""
+        return [
+            [list(entry[0]), entry[1], list(entry[2]), entry[3], entry[4]]
+            for entry in self.heap
+        ]
+
+    def restore(self, state):
+        self.heap = [
+            (tuple(entry[0]), entry[1], tuple(entry[2]), entry[3], entry[4])
+            for entry in state
+        ]
+
+    def rows(self):
+        """Return the selected portfolios in calibration order as result columns."""
+        entries = sorted(self.heap, key=lambda entry: entry[1])
+        rows = {
+            "name": [f"x{i}" for i in range(1, len(entries) + 1)],
+            "combination": [entry[2] for entry in entries],
+            "weights": [entry[3] for entry in entries],
+        }
+        for name in entries[0][4] if entries else []:
+            rows[name] = np.array([entry[4][name] for entry in entries])
+        return rows
+
+
+def _weight_units(partitions, increment, total, tolerance):
+    """
+    Express the weights as integer units of the increment.
+
+    Every weight is n * increment with 0 <= n <= total / increment. Returns the
+    largest unit, the unit totals a valid weight vector may sum up to (those
+    within the tolerance of total) and the Decimal increment.
+    """
+    getcontext().prec = 8
+    increment = Decimal(str(increment))
+    total = Decimal(str(total))
+    tolerance = Decimal(str(tolerance))
+    max_units = int(total / increment)
+
+    lowest = max(partitions, math.ceil((total - tolerance) / increment))
+    highest = min(partitions * max_units, math.floor((total + tolerance) / increment))
+    valid_totals = [
+        units
+        for units in range(lowest, highest + 1)
+        if abs(units * increment - total) <= tolerance
+    ]
+    return max_units, valid_totals, increment
+
+
+def count_valid_weights(partitions, increment, total=1.0, tolerance=1e-2):
+    """
+    Count the valid weight vectors without enumerating them.
+
+    A vector of `partitions` positive weights is valid if its units sum up to one of
+    the valid totals. For every such total N the number of compositions of N into
+    `partitions` positive parts of at most max_units is counted by inclusion-exclusion.
+    """
+    if not partitions or not increment or increment <= 0:
+        return 0
+    max_units, valid_totals, _ = _weight_units(partitions, increment, total, tolerance)
+    number = 0
+    for units in valid_totals:
+        for j in range(partitions + 1):
+            remaining = units - j * max_units - 1
+            if remaining < partitions - 1:
+                break
+            number += (
+                (-1) ** j
+                * math.comb(partitions, j)
+                * math.comb(remaining, partitions - 1)
+            )
+    return number
+
+
+@lru_cache(maxsize=64)
+def get_weight_lattice(partitions, increment, total=1.0, tolerance=1e-2):
+    """
+    Enumerate the valid weight vectors as a (portfolios x partitions) array of units.
+
+    Only the valid compositions are generated, in the same lexicographic order the
+    itertools.product filter produced them. The array is cached and read only.
+    """
+    lattice = np.zeros((0, partitions or 0), dtype=np.int64)
+    lattice.setflags(write=False)
+    if not partitions or not increment or increment <= 0:
+        return lattice
+    max_units, valid_totals, _ = _weight_units(partitions, increment, total, tolerance)
+    if not valid_totals:
+        return lattice
+    lowest, highest = valid_totals[0], valid_totals[-1]
+
+    vectors = []
+    vector = [0] * partitions
+
+    def fill(position, units):
+        remaining = partitions - position - 1
+        for value in range(1, max_units + 1):
+            # Stop once the other positions can no longer stay within the totals
+            if units + value + remaining > highest:
+                break
+            if units + value + remaining * max_units < lowest:
+                continue
+            vector[position] = value
+            if remaining:
+                fill(position + 1, units + value)
+            elif units + value in valid_totals:
+                vectors.append(tuple(vector))
+
+    fill(0, 0)
+    if vectors:
+        lattice = np.array(vectors, dtype=np.int64)
+        lattice.setflags(write=False)
+    return lattice
+
+
+@lru_cache(maxsize=64)
+def get_weight_matrix(partitions, increment, total=1.0, tolerance=1e-2):
+    """Return the valid weight vectors of get_weight_lattice as a float matrix."""
+    lattice = get_weight_lattice(partitions, increment, total, tolerance)
+    max_units, _, decimal_increment = _weight_units(
+        partitions, increment, total, tolerance
+    )
+    # Convert every unit once through Decimal, so 3 units of 0.1 are exactly 0.3
+    values = np.array(
+        [float(units * decimal_increment) for units in range(max_units + 1)]
+    )
+    weights = values[lattice]
+    weights.setflags(write=False)
+    return weights
+
+
+class Calibration:
+    """
+    Calculates the portfolio universe of a Series frame and writes it to a ResultWriter.
+
+    The portfolios are numbered in calibration order: partitions ascending, then
+    itertools.combinations order, then the weight lattice order. The progress is a
+    (partition, position) cursor of completed combinations, which is what a
+    checkpoint stores to resume the run later.
+    """
+
+    def __init__(
+        self,
+        prices,
+        column_names,
+        partitions,
+        step_size,
+        top_x=None,
+        top_x_keys=("risk",),
+        workers=1,
+        shard_size=16,
+        cache_budget=NORMALISATION_CACHE_BUDGET,
+    ):
+        self.prices = prices
+        self.column_names = list(column_names)
+        self.partitions = partitions
+        self.step_size = step_size
+        self.top_x = top_x
+        self.top_x_keys = list(top_x_keys)
+        self.workers = workers
+        self.shard_size = shard_size
+        self.cache_budget = cache_budget
+
+        # The weights are the same for every combination of a partition
+        self.weight_matrices = {}
+        self.weight_lists = {}
+        for partition in range(1, partitions + 1):
+            weight_matrix = get_weight_matrix(partition, step_size)
+            if len(weight_matrix):
+                self.weight_matrices[partition] = weight_matrix
+                self.weight_lists[partition] = weight_matrix.tolist()
+
+        self.total_number = sum(
+            math.comb(len(self.column_names), partition) * len(weights)
+            for partition, weights in self.weight_lists.items()
+        )
+
+    def fingerprint(self):
+        """Identify the input data and settings, a checkpoint only resumes the same run."""
+        settings = json.dumps(
+            [
+                self.column_names,
+                self.partitions,
+                str(self.step_size),
+                self.top_x,
+                self.top_x_keys,
+                # Checkpoints of older versions lack state columns
+                PortfolioState.COLUMNS,
+            ]
+        ).encode()
+        data = pd.util.hash_pandas_object(self.prices, index=True).to_numpy()
+        return hashlib.md5(settings + data.tobytes()).hexdigest()
+
+    def reference_state(self):
+        prices = pd.to_numeric(self.prices["RI"], errors="coerce").dropna()
+        normalised_ri = normalise_prices(prices.to_numpy(dtype=float)[:, None])
+        return PortfolioState.from_curves(normalised_ri)
+
+    def run(
+        self, writer, set_progress=None, checkpoint=None, state=None, curve_path=None
+    ):
+        """
+        Calculate all portfolios and write RI plus the (selected) portfolios.
+
+        If a checkpoint is given its save is called regularly with the current
+        state. Passing such a state continues the run from its cursor, the writer has
+        to be opened with the writer offset of the same state. With a top_x limit
+        and a curve_path the curves of the selected portfolios are written there as
+        well, see CurveStore.
+        """
+        index = 1
+        percentage = 0
+        cursor = None
+        selector = None
+        # Without a limit every portfolio is written, otherwise only the best top_x are kept
+        if self.top_x:
+            selector = TopKSelector(self.top_x, self.top_x_keys)
+        # Written rows can only be resumed if the writer can continue its file
+        if selector is None and not writer.supports_resume:
+            checkpoint = None
+
+        if state is not None:
+            index = state["index"]
+            percentage = state["percentage"]
+            cursor = (state["partition"], state["position"])
+            if selector is not None:
+                selector.restore(state["selected"])
+
+        shards = shard_combinations(
+            self.column_names, self.weight_matrices.keys(), self.shard_size, cursor
+        )
+        results = run_calibration(
+            self.prices,
+            shards,
+            self.weight_matrices,
+            self.workers,
+            self.cache_budget,
+            self.top_x or None,
+            selector.min_cagr if selector is not None else None,
+        )
+        partition, position = cursor or (None, 0)
+
+        with writer:
+            if not writer.resumed:
+                writer.write_rows(
+                    name=["RI"],
+                    combination=[("RI",)],
+                    weights=[[1.0]],
+                    **self.reference_state().columns(),
+                )
+            for combination_partition, combination, result in results:
+                if combination_partition != partition:
+                    partition, position = combination_partition, 0
+                weights = self.weight_lists[partition]
+                number_weights = len(weights)
+                positions, columns = result
+                if selector is not None:
+                    selector.offer(index, combination, weights, columns, positions)
+                else:
+                    writer.write_rows(
+                        name=[f"x{i}" for i in range(index, index + number_weights)],
+                        combination=[combination] * number_weights,
+                        weights=weights,
+                        **columns,
+                    )
+
+                index += number_weights
+                position += 1
+                new_percentage = int((index - 1) / self.total_number * 100)
+                if new_percentage != percentage:
+                    percentage = new_percentage
+                    if set_progress is not None:
+                        set_progress(percentage)
+
+                if checkpoint is not None and checkpoint.due():
+                    checkpoint.save(
+                        {
+                            "partition": partition,
+                            "position": position,
+                            "index": index,
+                            "percentage": percentage,
+                            "writer_offset": (
+                                writer.tell() if selector is None else None
+                            ),
+                            "selected": (
+                                selector.state() if selector is not None else None
+                            ),
+                        }
+                    )
+
+            if selector is not None:
+                rows = selector.rows()
+                writer.write_rows(**rows)
+                if curve_path is not None:
+                    build_curve_store(self.prices, rows).write_ipc(curve_path)
+        return writer.path
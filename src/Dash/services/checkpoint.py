@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import logging
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+
+class CalibrationCheckpoint:
+    """
+    Stores the cursor and the partial results of a running calibration on disk.
+
+    The checkpoint is tied to the fingerprint of the calibration input, load only
+    returns a state written for the same Series data and settings.
+
+    With an S3 bucket every save is also uploaded as key, so a run can be resumed
+    after the local disk is gone, e.g. when a dyno restarts. Only the state is
+    uploaded, a run without top X limit also needs its local partial result file.
+    """
+
+    def __init__(self, path, fingerprint, interval=60, bucket=None, key=None):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.bucket = bucket
+        self.key = key
+        self.last_saved = time.monotonic()
+        self.logger = logging.getLogger(__name__)
+
+    def due(self):
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def save(self, state):
+        state = dict(state, fingerprint=self.fingerprint)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Replace the previous checkpoint in one step, a crash leaves either one intact
+        os.replace(temp_path, self.path)
+        self.last_saved = time.monotonic()
+        if self.bucket is not None:
+            try:
+                self.bucket.upload_file(str(self.path), self.key)
+            except Exception:
+                # The run goes on, it can still be resumed from the local checkpoint
+                self.logger.exception(f"Could not upload the checkpoint to {self.key}")
+
+    def load(self):
+        """The saved state, the local one first and the uploaded one otherwise."""
+        if self.path.exists():
+            with open(self.path) as f:
+                state = json.load(f)
+        elif self.bucket is not None:
+            try:
+                state = json.load(self.bucket.Object(self.key).get()["Body"])
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "NoSuchKey":
+                    raise
+                return None
+        else:
+            return None
+        if state.get("fingerprint") != self.fingerprint:
+            return None
+        return state
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+        if self.bucket is not None:
+            self.bucket.Object(self.key).delete()
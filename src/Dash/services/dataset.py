@@ -0,0 +1,548 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
+
+
+def read_ipc_table(path):
+    """Memory map an Arrow IPC file, its columns are only paged in when touched."""
+    return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+
+def read_ipc_mapped(path):
+    """A memory mapped Arrow IPC file as a polars frame, strings are copied."""
+    return pl.from_arrow(read_ipc_table(path), rechunk=False)
+
+
+def pareto_frontier(risk, cagr):
+    """
+    Positions of the portfolios without any other portfolio that has less risk and a
+    higher CAGR, ordered by risk. Sorting by risk first makes this O(n log n).
+    """
+    if len(risk) == 0:
+        return np.arange(0)
+    order = np.lexsort((-cagr, risk))
+    sorted_cagr = cagr[order]
+    best = np.maximum.accumulate(sorted_cagr)
+    keep = np.empty(len(order), dtype=bool)
+    keep[0] = True
+    keep[1:] = sorted_cagr[1:] > best[:-1]
+    return order[keep]
+
+
+class DatasetCache:
+    """
+    Process wide cache of parsed data files, versioned by the ETag of the S3 object.
+
+    Every access revalidates the cached copy with a conditional GET. The file is only
+    downloaded and parsed again when the object changed, e.g. after an admin upload
+    or a new calibration.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.path_locks = {}
+        self.lock = threading.Lock()
+
+    def path_lock(self, path):
+        with self.lock:
+            return self.path_locks.setdefault(path, threading.Lock())
+
+    def get(self, path, fetch, parse):
+        """
+        Return (version, parsed data) of a file.
+
+        fetch(path, version) returns the body and the version of the file, the body is
+        None if the given version is still current. parse(body, version, fetched_at)
+        turns a body into the data, fetched_at is the time of the request for it.
+
+        The revalidation runs without a lock. Parsing a new version only holds the lock
+        of its path, so a slow download of one file does not block the others.
+        """
+        with self.lock:
+            version, data = self.entries.get(path, (None, None))
+        fetched_at = time.time()
+        body, new_version = fetch(path, version)
+        if body is None:
+            return version, data
+        with self.path_lock(path):
+            with self.lock:
+                current = self.entries.get(path, (None, None))
+            # Another request parsed this version while we waited for the lock
+            if current[0] == new_version:
+                body.close()
+                return current
+            data = parse(body, new_version, fetched_at)
+            with self.lock:
+                self.entries[path] = (new_version, data)
+        return new_version, data
+
+    def version(self, path):
+        """The version of the cached copy of a file, without revalidating it."""
+        with self.lock:
+            return self.entries.get(path, (None, None))[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+def decode_lists(array):
+    """
+    Flatten an Arrow list column (or python literals of lists in a CSV file) into the
+    values and the offsets of every row.
+
+    Works chunk by chunk with Arrow kernels, no python object is created per row. The
+    literals are split as text, the values of the calibration are plain names and
+    numbers.
+    """
+    if isinstance(array, pa.Array):
+        array = pa.chunked_array([array])
+    chunks = array.chunks or [pa.array([], array.type)]
+    values, lengths = [], []
+    for chunk in chunks:
+        if pa.types.is_string(chunk.type) or pa.types.is_large_string(chunk.type):
+            chunk = pc.split_pattern(pc.utf8_trim(chunk, "()[], "), ", ")
+            values.append(pc.utf8_trim(pc.list_flatten(chunk), "'\""))
+        else:
+            values.append(pc.list_flatten(chunk))
+        lengths.append(pc.list_value_length(chunk).fill_null(0).to_numpy())
+    lengths = np.concatenate(lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return pa.chunked_array(values, values[0].type), offsets
+
+
+def encode_values(values):
+    """The distinct values and the code of every value, by Arrow dictionary encoding."""
+    encoded = values.dictionary_encode().unify_dictionaries()
+    codes = np.concatenate([chunk.indices.to_numpy() for chunk in encoded.chunks])
+    return np.array(encoded.chunk(0).dictionary.to_pylist(), dtype=str), codes
+
+
+class SharedDatasets:
+    """
+    Parsed datasets published as files in shared memory, one directory per version.
+
+    The first gunicorn worker that needs a version parses it and publishes the arrays.
+    Every worker, the publishing one included, memory maps the published files, so
+    the workers share the pages instead of holding a copy each.
+
+    The modification time of a version directory is the time its file was fetched. A
+    worker that publishes a version only removes the versions fetched before it, so
+    a worker that is still busy with an outdated download can not remove a newer one.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name, version):
+        return self.directory / f"{name}-{hashlib.md5(version.encode()).hexdigest()}"
+
+    def get(self, name, version, dataset_class, build, fetched_at=None):
+        """
+        Attach to the published version of a dataset, build() is only called if the
+        version was not published yet.
+        """
+        path = self.path(name, version)
+        if not path.exists():
+            self.publish(name, path, build(), fetched_at or time.time())
+        return dataset_class.load(path)
+
+    def publish(self, name, path, dataset, fetched_at):
+        temp_path = Path(tempfile.mkdtemp(dir=self.directory, prefix=".publish-"))
+        dataset.save(temp_path)
+        try:
+            os.rename(temp_path, path)
+            os.utime(path, (fetched_at, fetched_at))
+        except OSError:
+            # Another worker published the same version in the meantime
+            shutil.rmtree(temp_path, ignore_errors=True)
+        # Open memory maps of old versions stay valid after the files are removed
+        for old_path in self.directory.glob(f"{name}-*"):
+            try:
+                outdated = old_path.stat().st_mtime < fetched_at
+            except FileNotFoundError:
+                continue
+            if old_path != path and outdated:
+                shutil.rmtree(old_path, ignore_errors=True)
+
+
+class GridIndex:
+    """
+    Uniform grid over two coordinates for nearest neighbour queries.
+
+    The rows of every cell are stored contiguously (order, with the cell boundaries in
+    starts). A query searches rings of cells around the query point until no unseen
+    cell can hold a closer point than the k found so far.
+    """
+
+    arrays = ["order", "starts", "bounds"]
+
+    def __init__(self, x, y, order, starts, bounds):
+        self.x = x
+        self.y = y
+        self.order = order
+        self.starts = starts
+        self.bounds = bounds
+        self.x0, self.y0, self.width, self.height, cells = bounds
+        self.cells = int(cells)
+
+    @classmethod
+    def build(cls, x, y, rows, points_per_cell=4):
+        cells = max(1, int(np.sqrt(len(rows) / points_per_cell)))
+        bounds = [0.0, 0.0, 1.0, 1.0, cells]
+        if len(rows):
+            x0, y0 = x[rows].min(), y[rows].min()
+            width = (x[rows].max() - x0) / cells or 1.0
+            height = (y[rows].max() - y0) / cells or 1.0
+            bounds = [x0, y0, width, height, cells]
+        index = cls(x, y, None, None, np.array(bounds, dtype=np.float64))
+        cell = index.cell(x[rows], y[rows])
+        index.order = rows[np.argsort(cell, kind="stable")]
+        index.starts = np.zeros(cells * cells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=cells * cells), out=index.starts[1:])
+        return index
+
+    def cell_xy(self, x, y):
+        ix = np.clip(((x - self.x0) // self.width).astype(np.int64), 0, self.cells - 1)
+        iy = np.clip(((y - self.y0) // self.height).astype(np.int64), 0, self.cells - 1)
+        return ix, iy
+
+    def cell(self, x, y):
+        ix, iy = self.cell_xy(x, y)
+        return ix * self.cells + iy
+
+    def ring(self, ix, iy, radius):
+        """Cells with a Chebyshev distance of radius to (ix, iy) inside the grid."""
+        if radius == 0:
+            return [ix * self.cells + iy]
+        cells = []
+        for cx in range(max(ix - radius, 0), min(ix + radius, self.cells - 1) + 1):
+            if abs(cx - ix) == radius:
+                cys = range(max(iy - radius, 0), min(iy + radius, self.cells - 1) + 1)
+            else:
+                cys = [cy for cy in (iy - radius, iy + radius) if 0 <= cy < self.cells]
+            cells.extend(cx * self.cells + cy for cy in cys)
+        return cells
+
+    def nearest(self, x, y, k):
+        """The k rows closest to (x, y), closest first."""
+        if k <= 0:
+            return np.arange(0)
+        ix, iy = self.cell_xy(np.float64(x), np.float64(y))
+        ix, iy = int(ix), int(iy)
+        candidates = np.arange(0)
+        distances = np.arange(0.0)
+        step = min(self.width, self.height)
+        for radius in range(self.cells):
+            rows = [
+                self.order[self.starts[cell] : self.starts[cell + 1]]
+                for cell in self.ring(ix, iy, radius)
+            ]
+            rows = np.concatenate([candidates] + rows)
+            distances = np.hypot(self.x[rows] - x, self.y[rows] - y)
+            if len(rows) > k:
+                keep = np.argpartition(distances, k - 1)[:k]
+                rows, distances = rows[keep], distances[keep]
+            candidates = rows
+            # Points in cells outside the searched rings are at least this far away
+            if len(candidates) == k and distances.max() <= radius * step:
+                break
+        order = np.argsort(distances, kind="stable")
+        return candidates[order]
+
+
+class Universe:
+    """
+    Portfolio universe with an index from series name to row.
+
+    Combination and weights of all rows are decoded once into flat arrays, so a lookup
+    is an index access and two slices. The calibration names row i x{i} and the first
+    row RI, such universes need no dictionary for the index.
+
+    The rows of the Pareto frontier over (Risk, CAGR) and a grid index over the same
+    plane are computed along with the rest, once per version of the universe.
+    """
+
+    reference_series = "RI"
+    list_columns = ["Combination", "Weights"]
+    arrays = ["offsets", "columns", "codes", "weights", "frontier"]
+
+    def __init__(self, frame, offsets, columns, codes, weights, frontier, grid=None):
+        self.frame = frame
+        self.offsets = offsets
+        self.columns = columns
+        self.codes = codes
+        self.weights = weights
+        self.frontier = frontier
+        self.index = None if self.numbered_rows() else self.build_index()
+        self.grid = grid or GridIndex.build(
+            self.frame["Risk"].to_numpy(),
+            self.frame["CAGR"].to_numpy(),
+            np.flatnonzero((frame["Series"] != self.reference_series).to_numpy()),
+        )
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Decode a polars frame or an Arrow table of a result file. Combination and
+        Weights are only kept decoded. The lists of an Arrow table, e.g. of a memory
+        mapped file, are decoded in place and only the other columns are converted to
+        polars, the numbers without a copy.
+        """
+        if isinstance(frame, pa.Table):
+            lists = [frame[name] for name in cls.list_columns]
+            frame = pl.from_arrow(frame.drop_columns(cls.list_columns), rechunk=False)
+        else:
+            lists = [frame[name].to_arrow() for name in cls.list_columns]
+            frame = frame.drop(cls.list_columns)
+        combinations, offsets = decode_lists(lists[0])
+        columns, codes = encode_values(combinations)
+        weights, _ = decode_lists(lists[1])
+        weights = pc.cast(weights, pa.float64()).to_numpy()
+        portfolios = np.flatnonzero(
+            (frame["Series"] != cls.reference_series).to_numpy()
+        )
+        frontier = portfolios[
+            pareto_frontier(
+                frame["Risk"].to_numpy()[portfolios],
+                frame["CAGR"].to_numpy()[portfolios],
+            )
+        ]
+        return cls(
+            frame,
+            offsets,
+            columns,
+            codes,
+            weights,
+            frontier,
+        )
+
+    def numbered_rows(self):
+        names = self.frame["Series"]
+        if len(names) == 0 or names[0] != self.reference_series:
+            return False
+        numbers = names.slice(1).str.slice(1).cast(pl.Int64, strict=False)
+        return bool(
+            names.slice(1).str.starts_with("x").all()
+            and (numbers == pl.int_range(1, len(names), eager=True)).all()
+        )
+
+    def build_index(self):
+        return {name: row for row, name in enumerate(self.frame["Series"])}
+
+    def row(self, series):
+        if self.index is not None:
+            return self.index[series]
+        if series == self.reference_series:
+            return 0
+        if not series.startswith("x") or not series[1:].isdigit():
+            raise KeyError(series)
+        row = int(series[1:])
+        if not 0 < row < len(self.frame) or self.frame["Series"][row] != series:
+            raise KeyError(series)
+        return row
+
+    def combination_weights(self, series):
+        row = self.row(series)
+        start, end = self.offsets[row], self.offsets[row + 1]
+        combination = self.columns[self.codes[start:end]].tolist()
+        return combination, self.weights[start:end].tolist()
+
+    def save(self, path):
+        self.frame.write_ipc(path / "universe.arrow")
+        for name in self.arrays:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        for name in GridIndex.arrays:
+            np.save(path / f"grid_{name}.npy", getattr(self.grid, name))
+
+    @classmethod
+    def load(cls, path):
+        frame = read_ipc_mapped(path / "universe.arrow")
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r") for name in cls.arrays
+        }
+        grid = GridIndex(
+            frame["Risk"].to_numpy(),
+            frame["CAGR"].to_numpy(),
+            *(
+                np.load(path / f"grid_{name}.npy", mmap_mode="r")
+                for name in GridIndex.arrays
+            ),
+        )
+        return cls(frame, grid=grid, **arrays)
+
+
+class PriceStore:
+    """
+    Series.csv as arrays: the dates as int64 nanoseconds, the prices as one contiguous
+    float64 matrix and the first valid row of every column.
+
+    The rows are sorted by date for the lookups, order keeps the rows of the file
+    in date order so frame can return them as the file has them.
+
+    A weighted portfolio is then a slice of the matrix and one dot product.
+    """
+
+    def __init__(self, dates, columns, prices, filled=None, order=None):
+        self.dates = dates
+        self.columns = columns
+        self.column_index = {column: i for i, column in enumerate(columns)}
+        self.prices = prices
+        valid = ~np.isnan(prices)
+        self.first_valid = np.where(valid.any(axis=0), valid.argmax(axis=0), len(valid))
+        # Missing prices do not contribute to the weighted sum, like DataFrame.sum
+        self.filled = np.nan_to_num(prices) if filled is None else filled
+        self.order = np.arange(len(dates)) if order is None else order
+
+    @classmethod
+    def from_frame(cls, frame):
+        dates = frame.index.values.astype("datetime64[ns]").view(np.int64)
+        order = np.argsort(dates, kind="stable")
+        return cls(
+            dates[order],
+            list(frame.columns),
+            np.ascontiguousarray(frame.to_numpy(dtype=np.float64)[order]),
+            order=order,
+        )
+
+    @property
+    def frame(self):
+        """The prices as a DataFrame indexed by date, in the row order of the file."""
+        rows = np.empty_like(self.order)
+        rows[self.order] = np.arange(len(self.order))
+        return pd.DataFrame(
+            self.prices[rows], index=self.index()[rows], columns=self.columns
+        )
+
+    def index(self, start=0):
+        return pd.DatetimeIndex(self.dates[start:].view("datetime64[ns]"), name="Date")
+
+    def weighted_series(self, combination, weights):
+        """
+        Portfolio curve starting at 100 from the first month all columns have prices.
+
+        Returns the first row of the curve and the curve.
+        """
+        columns = [self.column_index[column] for column in combination]
+        start = self.first_valid[columns].max()
+        base = self.prices[start, columns]
+        scale = np.nan_to_num(np.asarray(weights, dtype=np.float64) * 100 / base)
+        return start, self.filled[start:, columns] @ scale
+
+    def normalised(self, column, start=0):
+        prices = self.prices[start:, self.column_index[column]]
+        return prices / prices[0] * 100
+
+    def save(self, path):
+        np.save(path / "dates.npy", self.dates)
+        np.save(path / "columns.npy", np.array(self.columns, dtype=str))
+        np.save(path / "prices.npy", self.prices)
+        np.save(path / "filled.npy", self.filled)
+        np.save(path / "order.npy", self.order)
+
+    @classmethod
+    def load(cls, path):
+        return cls(
+            np.load(path / "dates.npy", mmap_mode="r"),
+            np.load(path / "columns.npy").tolist(),
+            np.load(path / "prices.npy", mmap_mode="r"),
+            np.load(path / "filled.npy", mmap_mode="r"),
+            np.load(path / "order.npy", mmap_mode="r"),
+        )
+
+
+class CurveStore:
+    """
+    Portfolio curves precomputed by a calibration, indexed by series name.
+
+    The curves are one float32 (portfolios x months) matrix over the dates of
+    Series.csv, NaN in the months a portfolio is not calculated. Every row keeps the
+    combination and weights it was calculated for, so the store of an older
+    calibration or Series.csv never answers for a different portfolio.
+    """
+
+    arrays = ["dates", "names", "keys", "curves"]
+
+    def __init__(self, dates, names, keys, curves):
+        self.dates = dates
+        self.names = names
+        self.row_index = {name: i for i, name in enumerate(names)}
+        self.keys = keys
+        self.curves = curves
+
+    @staticmethod
+    def portfolio_key(combination, weights):
+        return json.dumps([list(combination), [float(weight) for weight in weights]])
+
+    def curve(self, series, combination, weights, dates):
+        """The stored curve of a portfolio over dates, None if it is not stored."""
+        row = self.row_index.get(series)
+        if row is None or self.keys[row] != self.portfolio_key(combination, weights):
+            return None
+        if not np.array_equal(self.dates, dates):
+            return None
+        return self.curves[row]
+
+    def write_ipc(self, path):
+        """Write the store as a single Arrow IPC file, e.g. for the upload."""
+        months = len(self.dates)
+        table = pa.table(
+            {
+                "name": pa.array(self.names, pa.string()),
+                "key": pa.array(self.keys, pa.string()),
+                "curve": pa.FixedSizeListArray.from_arrays(
+                    pa.array(np.ravel(self.curves), pa.float32()), months
+                ),
+            }
+        ).replace_schema_metadata({"dates": json.dumps(self.dates.tolist())})
+        with pa.OSFile(str(path), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    @classmethod
+    def from_ipc(cls, source):
+        """
+        Read a store written by write_ipc. The curves of a memory mapped source are
+        a view of the map, not a copy.
+        """
+        table = pa.ipc.open_file(source).read_all()
+        dates = np.array(json.loads(table.schema.metadata[b"dates"]), dtype=np.int64)
+        curve = table["curve"]
+        # write_ipc writes a single batch, only concatenate the curves of others
+        curve = curve.chunk(0) if curve.num_chunks == 1 else curve.combine_chunks()
+        curves = curve.flatten().to_numpy()
+        return cls(
+            dates,
+            table["name"].to_pylist(),
+            np.array(table["key"].to_pylist(), dtype=str),
+            curves.reshape(len(table), len(dates)),
+        )
+
+    def save(self, path):
+        np.save(path / "dates.npy", self.dates)
+        np.save(path / "names.npy", np.array(self.names, dtype=str))
+        np.save(path / "keys.npy", self.keys)
+        np.save(path / "curves.npy", self.curves)
+
+    @classmethod
+    def load(cls, path):
+        return cls(
+            np.load(path / "dates.npy", mmap_mode="r"),
+            np.load(path / "names.npy").tolist(),
+            np.load(path / "keys.npy", mmap_mode="r"),
+            np.load(path / "curves.npy", mmap_mode="r"),
+        )
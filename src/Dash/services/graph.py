@@ -1,11 +1,22 @@
 import json
+import numpy as np
 import polars as pl
 from pathlib import Path
 import plotly.graph_objects as go
 from flask import current_app
 import plotly.express as px
+from dash import Patch
+from src.Dash.services.dataset import pareto_frontier
 
 color_set = px.colors.qualitative.Vivid
+# Units of the metrics in axes and hover labels, all others are percentages
+metric_units = {
+    "Age": "",
+    "Drawdown Duration": "",
+    "Sharpe": "",
+    "Sortino": "",
+    "Calmar": "",
+}
 cache = current_app.cache
 
 
@@ -26,40 +37,51 @@ class plotting_engine:
             self.working_directory, self.config_folder, self.graph_file
         )
 
-    def add_RI(self, data, configuration):
-        hover_text = [
-            f"Age (month): {age}"
-            for age in data.filter(pl.col("Series") == "RI")
-            .select("Age")
-            .to_series()
-            .to_list()
-        ]
+    def add_portfolios(self, scatter, columns, mask, **kwargs):
+        """
+        Add the rows selected by mask (a boolean mask or positions in drawing order)
+        as marker trace, columns are numpy arrays
+        """
+        kwargs.setdefault("mode", "markers")
         self.figure.add_trace(
-            go.Scatter(
-                x=data.filter(pl.col("Series") == "RI")
-                .select(configuration.get("x_value", "Risk"))
-                .to_series()
-                .to_list(),
-                y=data.filter(pl.col("Series") == "RI")
-                .select(configuration.get("y_value", "CAGR"))
-                .to_series()
-                .to_list(),
-                mode="markers",
-                customdata=data.filter(pl.col("Series") == "RI")
-                .select("Series")
-                .to_series()
-                .to_list(),
-                marker_color=data.filter(pl.col("Series") == "RI")
-                .select("color")
-                .to_series()
-                .to_list(),
-                name="RI",
-                marker=dict(color="#add8e6", size=8),
-                text=hover_text,
-                hovertemplate="Series: %{customdata}<br>CAGR: %{y:.2f}%<br>Risk: %{x:.2f}%<br>%{text}<extra></extra>",
+            scatter(
+                x=columns["x"][mask],
+                y=columns["y"][mask],
+                customdata=columns["Series"][mask],
+                text=columns["Age"][mask],
+                hovertemplate=self.hovertemplate,
+                **kwargs,
             )
         )
 
+    def add_RI(self, columns, mask, scatter=go.Scatter):
+        self.add_portfolios(
+            scatter,
+            columns,
+            mask,
+            name="RI",
+            marker=dict(color="#add8e6", size=8),
+        )
+
+    def get_unit(self, metric):
+        return metric_units.get(metric, "%")
+
+    def set_hovertemplate(self, configuration):
+        x_value = configuration.get("x_value", "Risk")
+        y_value = configuration.get("y_value", "CAGR")
+        self.hovertemplate = (
+            "Series: %{customdata}"
+            f"<br>{y_value}: %{{y:.2f}}{self.get_unit(y_value)}"
+            f"<br>{x_value}: %{{x:.2f}}{self.get_unit(x_value)}"
+            "<br>Age (month): %{text}<extra></extra>"
+        )
+
+    def get_scatter(self, number_points, configuration):
+        """SVG scatter traces get slow with many points, above the threshold use WebGL"""
+        if number_points > configuration.get("webgl_threshold", 10000):
+            return go.Scattergl
+        return go.Scatter
+
     def get_color(self, color):
         if isinstance(color, str):
             return color
@@ -95,11 +117,9 @@ class plotting_engine:
         color_dict = {"young": "#a8d4ff", "middle": "#0b88ff", "old": "#002446"}
 
         # Calculate Age Categories
-        age_values = (
-            data.filter(pl.col("Series") != "RI").select("Age").to_series().to_list()
-        )
-        min_age = min(age_values)
-        max_age = max(age_values)
+        age_values = data.filter(pl.col("Series") != "RI")["Age"]
+        min_age = age_values.min()
+        max_age = age_values.max()
         range_age = max_age - min_age
         section_length = range_age / 3
 
@@ -133,7 +153,11 @@ class plotting_engine:
         )
         return data, age_categories
 
-    def make_dispersion_plot(self, data):
+    def make_dispersion_plot(self, data, frontier=None):
+        """
+        frontier are the rows of data on the Pareto frontier, they are computed here if
+        not given.
+        """
         self.update_config()
         configuration = self.cofiguration.get("dispersion")
         self.init_graph(configuration)
@@ -144,101 +168,113 @@ class plotting_engine:
         self.figure.update_layout(clickmode="event+select")
 
         data, age_categories = self.prepare_age(data)
-
-        hover_text = [
-            f"Age (month): {age}"
-            for age in data.filter(pl.col("Series") != "RI")
-            .select("Age")
-            .to_series()
-            .to_list()
-        ]
-
-        self.figure.add_trace(
-            go.Scatter(
-                x=data.filter(pl.col("Series") != "RI")
-                .select(configuration.get("x_value", "Risk"))
-                .to_series()
-                .to_list(),
-                y=data.filter(pl.col("Series") != "RI")
-                .select(configuration.get("y_value", "CAGR"))
-                .to_series()
-                .to_list(),
-                mode="markers",
+        scatter = self.get_scatter(len(data), configuration)
+        self.set_hovertemplate(configuration)
+
+        # Partition the frame once, the traces get numpy arrays of their rows
+        columns = {
+            "x": data[configuration.get("x_value", "Risk")].to_numpy(),
+            "y": data[configuration.get("y_value", "CAGR")].to_numpy(),
+            "Series": data["Series"].to_numpy(),
+            "Age": data["Age"].to_numpy(),
+            "color": data["color"].to_numpy(),
+        }
+        ri = columns["Series"] == "RI"
+        cagr = data["CAGR"].to_numpy()
+        better = ~ri & (cagr > cagr[ri][0])
+        selected = {
+            "marker": {"color": self.get_color(configuration.get("selected_color"))}
+        }
+        if frontier is None:
+            risk = data["Risk"].to_numpy()
+            frontier = np.flatnonzero(~ri)[pareto_frontier(risk[~ri], cagr[~ri])]
+        # Positions in risk order, the frontier is drawn as a line through them
+        efficient = self.thin(np.asarray(frontier), configuration)
+        density = len(data) > configuration.get("density_threshold", 200000)
+        if density:
+            self.add_density(columns, ~ri, configuration)
+            self.add_portfolios(
+                scatter,
+                columns,
+                efficient,
+                name="Pareto frontier",
+                marker_color=configuration.get("color_marker", "#004c94"),
+                selected=selected,
+            )
+            # Filled with the portfolios of the zoom window by the explorer
+            self.add_portfolios(
+                scatter,
+                columns,
+                np.zeros(len(data), dtype=bool),
                 name="Portfolios",
-                customdata=data.filter(pl.col("Series") != "RI")
-                .select("Series")
-                .to_series()
-                .to_list(),
-                marker_color=data.filter(pl.col("Series") != "RI")
-                .select("color")
-                .to_series()
-                .to_list(),
-                text=hover_text,
-                hovertemplate="Series: %{customdata}<br>CAGR: %{y:.2f}%<br>Risk: %{x:.2f}%<br>%{text}<extra></extra>",
-                selected={
-                    "marker": {
-                        "color": self.get_color(configuration.get("selected_color"))
-                    }
-                },
+                marker_color=configuration.get("color_marker", "#004c94"),
+                selected=selected,
             )
-        )
-        ri_cagr = data.filter(pl.col("Series") == "RI").select("CAGR").item(0, 0)
-        filtered_data = data.filter(
-            (pl.col("Series") != "RI") & (pl.col("CAGR") > ri_cagr)
-        )
-        self.figure.add_trace(
-            go.Scatter(
-                x=filtered_data.filter(pl.col("Series") != "RI")
-                .select(configuration.get("x_value", "Risk"))
-                .to_series()
-                .to_list(),
-                y=filtered_data.filter(pl.col("Series") != "RI")
-                .select(configuration.get("y_value", "CAGR"))
-                .to_series()
-                .to_list(),
-                mode="markers",
+        else:
+            self.add_portfolios(
+                scatter,
+                columns,
+                ~ri,
                 name="Portfolios",
-                customdata=filtered_data.filter(pl.col("Series") != "RI")
-                .select("Series")
-                .to_series()
-                .to_list(),
-                marker_color=filtered_data.filter(pl.col("Series") != "RI")
-                .select("color")
-                .to_series()
-                .to_list(),
-                text=hover_text,
-                hovertemplate="Series: %{customdata}<br>CAGR: %{y:.2f}%<br>Risk: %{x:.2f}%<br>%{text}<extra></extra>",
-                selected={
-                    "marker": {
-                        "color": self.get_color(configuration.get("selected_color"))
-                    }
-                },
+                marker_color=columns["color"][~ri],
+                selected=selected,
             )
-        )
-        self.add_RI(data, configuration)
+            self.add_portfolios(
+                scatter,
+                columns,
+                better,
+                name="Portfolios",
+                marker_color=columns["color"][better],
+                selected=selected,
+                visible=False,
+            )
+            self.add_portfolios(
+                scatter,
+                columns,
+                efficient,
+                name="Efficient portfolios",
+                mode="lines+markers",
+                marker_color=columns["color"][efficient],
+                line=dict(color=self.get_color(configuration.get("selected_color"))),
+                selected=selected,
+                visible=False,
+            )
+        self.add_RI(columns, ri, scatter)
+        x_value = configuration.get("x_value", "Risk")
+        y_value = configuration.get("y_value", "CAGR")
         self.figure.update_yaxes(
-            ticksuffix=" %", anchor="free", title=configuration.get("y_value", "CAGR")
-        )
-        self.figure.update_xaxes(
-            ticksuffix=" %", title=configuration.get("x_value", "Risk")
+            ticksuffix=f" {self.get_unit(y_value)}", anchor="free", title=y_value
         )
+        self.figure.update_xaxes(ticksuffix=f" {self.get_unit(x_value)}", title=x_value)
+
+        if not density:
+            self.add_market_dropdown()
+        # The explorer only asks for the points of the zoom window in density mode
+        self.figure.update_layout(meta={"density": density})
+        self.figure.update_layout(showlegend=False)
+        return self.figure, age_categories
 
-        # Add dropdown
+    def add_market_dropdown(self):
         self.figure.update_layout(
             updatemenus=[
                 dict(
                     buttons=list(
                         [
                             dict(
-                                args=[{"visible": [True, False, True]}],
+                                args=[{"visible": [True, False, False, True]}],
                                 label="All Portfolios",
                                 method="update",
                             ),
                             dict(
-                                args=[{"visible": [False, True, True]}],
+                                args=[{"visible": [False, True, False, True]}],
                                 label="Better than market",
                                 method="update",
                             ),
+                            dict(
+                                args=[{"visible": [False, False, True, True]}],
+                                label="Efficient portfolios",
+                                method="update",
+                            ),
                         ]
                     ),
                     direction="down",
@@ -254,10 +290,64 @@ class plotting_engine:
                 ),
             ]
         )
-        self.figure.update_layout(showlegend=False)
-        return self.figure, age_categories
 
-    def make_performance_plot(self, data, series):
+    def thin(self, positions, configuration):
+        """Keep at most max_points of the positions, evenly spread"""
+        max_points = configuration.get("max_points", 5000)
+        if len(positions) <= max_points:
+            return positions
+        return positions[np.linspace(0, len(positions) - 1, max_points).astype(int)]
+
+    def add_density(self, columns, mask, configuration):
+        """
+        Bin the portfolios into a 2D histogram and draw the counts as heatmap, the
+        hover shows the median age of the bin. The size does not depend on the
+        number of portfolios.
+        """
+        bins = configuration.get("density_bins", 100)
+        x, y, age = columns["x"][mask], columns["y"][mask], columns["Age"][mask]
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+        x_bin = np.clip(np.searchsorted(x_edges, x, side="right") - 1, 0, bins - 1)
+        y_bin = np.clip(np.searchsorted(y_edges, y, side="right") - 1, 0, bins - 1)
+        median_age = (
+            pl.DataFrame({"bin": x_bin * bins + y_bin, "age": age})
+            .group_by("bin")
+            .agg(pl.col("age").median())
+        )
+        ages = np.full(bins * bins, np.nan)
+        ages[median_age["bin"].to_numpy()] = median_age["age"].to_numpy()
+        # Heatmaps are indexed [y][x], empty bins stay transparent
+        counts[counts == 0] = np.nan
+        self.figure.add_trace(
+            go.Heatmap(
+                x=(x_edges[:-1] + x_edges[1:]) / 2,
+                y=(y_edges[:-1] + y_edges[1:]) / 2,
+                z=counts.T,
+                customdata=ages.reshape(bins, bins).T,
+                colorscale="Blues",
+                showscale=False,
+                name="Density",
+                hovertemplate="Portfolios: %{z}<br>Median age (month): %{customdata:.0f}<extra></extra>",
+            )
+        )
+
+    def make_zoom_patch(self, data):
+        """Patch the portfolio markers of a density plot with the given portfolios"""
+        self.update_config()
+        configuration = self.cofiguration.get("dispersion")
+        patch = Patch()
+        patch["data"][2]["x"] = data[configuration.get("x_value", "Risk")].to_numpy()
+        patch["data"][2]["y"] = data[configuration.get("y_value", "CAGR")].to_numpy()
+        patch["data"][2]["customdata"] = data["Series"].to_numpy()
+        patch["data"][2]["text"] = data["Age"].to_numpy()
+        return patch
+
+    def make_performance_plot(self, data, series, rolling=None):
+        """
+        rolling maps windows in months to the rolling metrics of the series, as
+        returned by LocalAPI.get_rolling_metrics. They are added as hidden traces on
+        a second axis, to be switched on in the legend.
+        """
         try:
             self.update_config()
             configuration = self.cofiguration.get("performance")
@@ -297,6 +387,7 @@ class plotting_engine:
                     ),
                 )
             )
+            self.add_rolling_metrics(data.index, rolling or {})
             self.figure.update_xaxes(
                 tickformat=configuration.get("date_format", "%d/%m/%Y"), tickangle=-45
             )
@@ -309,6 +400,31 @@ class plotting_engine:
         except Exception as e:
             return "error", e
 
+    def add_rolling_metrics(self, dates, rolling):
+        names = {"cagr": "CAGR", "volatility": "Volatility", "drawdown": "Drawdown"}
+        dashes = {"cagr": "solid", "volatility": "dash", "drawdown": "dot"}
+        for window, metrics in rolling.items():
+            for metric, name in names.items():
+                self.figure.add_trace(
+                    go.Scatter(
+                        x=dates,
+                        y=metrics[metric],
+                        mode="lines",
+                        name=f"{name} {window}M",
+                        legendgroup=f"rolling_{window}",
+                        line=dict(width=1, dash=dashes[metric]),
+                        yaxis="y2",
+                        visible="legendonly",
+                        hovertemplate="%{y:.2f}%",
+                    )
+                )
+        if rolling:
+            self.figure.update_layout(
+                yaxis2=dict(
+                    title="Rolling (%)", overlaying="y", side="right", showgrid=False
+                )
+            )
+
     def make_pie_chart(self, labels, values, series):
         self.update_config()
         configuration = self.cofiguration.get("composition")
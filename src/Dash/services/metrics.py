@@ -0,0 +1,263 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# Metrics of a portfolio. Percentages except age and drawdown_duration (months) and
+# the sharpe, sortino and calmar ratios
+METRICS = [
+    "cagr",
+    "risk",
+    "age",
+    "volatility",
+    "max_drawdown",
+    "drawdown_duration",
+    "sharpe",
+    "sortino",
+    "calmar",
+    "best_12m",
+    "worst_12m",
+]
+
+
+def down_months(curves):
+    """Number of months each column lost value against the previous month."""
+    return (curves[1:] / curves[:-1] < 1.0).sum(axis=0)
+
+
+def cagr(last, months):
+    """Compound annual growth rate of series starting at 100."""
+    return ((last / 100) ** (12 / months) - 1) * 100
+
+
+def risk(down, months):
+    """Share of down months."""
+    return down / months * 100
+
+
+def underwater_months(below, current):
+    """
+    Running length of the streaks of months below the previous high, for every row of
+    the boolean (months x portfolios) matrix below. Streaks of current months from
+    before the first row are continued.
+    """
+    count = np.cumsum(below, axis=0)
+    reset = np.maximum.accumulate(np.where(below, 0, count), axis=0)
+    ended = np.maximum.accumulate(~below, axis=0)
+    return count - reset + np.where(ended, 0, current)
+
+
+def twelve_month_returns(curves):
+    """Returns over all windows of 12 months that fit into the rows of curves."""
+    return (curves[12:] / curves[:-12] - 1) * 100
+
+
+def rolling_max(values, window):
+    """Maximum of the last window values at every position, with a monotonic queue."""
+    result = np.empty(len(values))
+    queue = deque()
+    for i, value in enumerate(values):
+        while queue and values[queue[-1]] <= value:
+            queue.pop()
+        queue.append(i)
+        if queue[0] <= i - window:
+            queue.popleft()
+        result[i] = values[queue[0]]
+    return result
+
+
+def rolling_metrics(curve, window):
+    """
+    CAGR, volatility and drawdown of a portfolio curve over the trailing window months
+    at every month, NaN until the first full window. Cumulative sums make every
+    metric O(n) independent of the window.
+    """
+    curve = np.asarray(curve, dtype=float)
+    months = len(curve)
+    result = {name: np.full(months, np.nan) for name in ["cagr", "volatility"]}
+    if months >= window:
+        ratio = curve[window - 1 :] / curve[: months - window + 1]
+        result["cagr"][window - 1 :] = (ratio ** (12 / window) - 1) * 100
+    # A window of n months holds n - 1 monthly returns
+    count = window - 1
+    if months >= window and count > 1:
+        returns = curve[1:] / curve[:-1] - 1
+        sums = np.concatenate([[0.0], np.cumsum(returns)])
+        squares = np.concatenate([[0.0], np.cumsum(returns**2)])
+        window_sums = sums[count:] - sums[:-count]
+        window_squares = squares[count:] - squares[:-count]
+        variance = (window_squares - window_sums**2 / count) / (count - 1)
+        result["volatility"][window - 1 :] = np.sqrt(np.maximum(variance, 0) * 12) * 100
+    result["drawdown"] = (1 - curve / rolling_max(curve, window)) * 100
+    result["drawdown"][: window - 1] = np.nan
+    return result
+
+
+class PortfolioState:
+    """
+    Running state of portfolio value series, one entry per portfolio.
+
+    The state holds the first and the last value, the number of down months, the
+    sums of the monthly returns, their squares and their squared losses, the high
+    water mark with the current drawdown streak and the extremes of drawdown and
+    12 month returns. All metrics only depend on it, so appending months to the
+    series only needs the new values (and the last 12 for the 12 month returns).
+    """
+
+    COLUMNS = [
+        "first",
+        "last",
+        "down",
+        "sum_returns",
+        "sum_squares",
+        "sum_losses",
+        "peak",
+        "underwater",
+        "max_drawdown",
+        "drawdown_duration",
+        "best_12m",
+        "worst_12m",
+    ]
+
+    def __init__(self, length, **state):
+        self.length = length
+        for name in self.COLUMNS:
+            setattr(self, name, state[name])
+
+    @classmethod
+    def from_curves(cls, curves):
+        """Build the state of every column of a (months x portfolios) matrix."""
+        returns = curves[1:] / curves[:-1] - 1
+        peak = np.maximum.accumulate(curves, axis=0)
+        underwater = underwater_months(curves < peak, 0)
+        rolling = twelve_month_returns(curves)
+        with np.errstate(invalid="ignore"):
+            best_12m = rolling.max(axis=0) if len(rolling) else np.nan
+            worst_12m = rolling.min(axis=0) if len(rolling) else np.nan
+        portfolios = curves.shape[1]
+        return cls(
+            np.full(portfolios, curves.shape[0]),
+            first=curves[0].copy(),
+            last=curves[-1].copy(),
+            down=down_months(curves),
+            sum_returns=returns.sum(axis=0),
+            sum_squares=(returns**2).sum(axis=0),
+            sum_losses=(np.minimum(returns, 0) ** 2).sum(axis=0),
+            peak=peak[-1].copy(),
+            underwater=underwater[-1].copy(),
+            max_drawdown=((1 - curves / peak) * 100).max(axis=0),
+            drawdown_duration=underwater.max(axis=0),
+            best_12m=np.broadcast_to(best_12m, portfolios).copy(),
+            worst_12m=np.broadcast_to(worst_12m, portfolios).copy(),
+        )
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Restore the state from stored result columns."""
+        state = {name: np.array(columns[name], dtype=float) for name in cls.COLUMNS}
+        for name in ["down", "underwater", "drawdown_duration"]:
+            state[name] = state[name].astype(np.int64)
+        return cls(np.array(columns["age"], dtype=np.int64), **state)
+
+    def select(self, rows):
+        """The state of some of the portfolios."""
+        return PortfolioState(
+            self.length[rows],
+            **{name: getattr(self, name)[rows] for name in self.COLUMNS},
+        )
+
+    def assign(self, rows, state):
+        """Overwrite the state of some of the portfolios."""
+        self.length[rows] = state.length
+        for name in self.COLUMNS:
+            getattr(self, name)[rows] = getattr(state, name)
+
+    def update(self, curves, tail):
+        """
+        Append the next (months x portfolios) values of the same portfolios. tail
+        holds the last (up to 12) values the state already covers.
+        """
+        if not len(curves):
+            return
+        values = np.vstack([self.last[None, :], curves])
+        returns = values[1:] / values[:-1] - 1
+        self.down = self.down + down_months(values)
+        self.sum_returns = self.sum_returns + returns.sum(axis=0)
+        self.sum_squares = self.sum_squares + (returns**2).sum(axis=0)
+        self.sum_losses = self.sum_losses + (np.minimum(returns, 0) ** 2).sum(axis=0)
+
+        peak = np.maximum.accumulate(np.vstack([self.peak[None, :], curves]), axis=0)
+        peak = peak[1:]
+        underwater = underwater_months(curves < peak, self.underwater)
+        self.max_drawdown = np.fmax(
+            self.max_drawdown, ((1 - curves / peak) * 100).max(axis=0)
+        )
+        self.drawdown_duration = np.maximum(
+            self.drawdown_duration, underwater.max(axis=0)
+        )
+        self.peak = peak[-1].copy()
+        self.underwater = underwater[-1].copy()
+
+        # Windows that end in one of the new months
+        rolling = twelve_month_returns(np.vstack([tail, curves]))
+        if len(rolling):
+            self.best_12m = np.fmax(self.best_12m, rolling.max(axis=0))
+            self.worst_12m = np.fmin(self.worst_12m, rolling.min(axis=0))
+
+        self.last = curves[-1].copy()
+        self.length = self.length + curves.shape[0]
+
+    def metrics(self, risk_free_rate=0.0):
+        """
+        Calculate the metrics of every portfolio as dictionary of arrays.
+
+        Volatility is the annualized standard deviation of the monthly returns and
+        sharpe the annualized excess return over risk_free_rate (in percent) per
+        volatility. sortino uses the downside deviation instead, calmar relates the
+        CAGR to the max drawdown.
+        """
+        count = self.length - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_return = self.sum_returns / count
+            variance = (self.sum_squares - count * mean_return**2) / (count - 1)
+            volatility = np.sqrt(np.maximum(variance, 0) * 12) * 100
+            downside = np.sqrt(self.sum_losses / count * 12) * 100
+            annual_return = mean_return * 12 * 100
+            metrics = {
+                "cagr": cagr(self.last, self.length),
+                "risk": risk(self.down, self.length),
+                "age": self.length,
+                "volatility": volatility,
+                "max_drawdown": self.max_drawdown,
+                "drawdown_duration": self.drawdown_duration,
+                "sharpe": (annual_return - risk_free_rate) / volatility,
+                "sortino": (annual_return - risk_free_rate) / downside,
+                "best_12m": self.best_12m,
+                "worst_12m": self.worst_12m,
+            }
+            metrics["calmar"] = metrics["cagr"] / self.max_drawdown
+        return {name: metrics[name] for name in METRICS}
+
+    def columns(self):
+        """Return the metrics and the state as result columns."""
+        columns = self.metrics()
+        for name in self.COLUMNS:
+            columns[name] = getattr(self, name)
+        return columns
+
+
+def calculate_metrics(curves, risk_free_rate=0.0):
+    """
+    Calculate the metrics of every column of a (months x portfolios) matrix of
+    portfolio values starting at 100, in one vectorized pass.
+    """
+    curves = np.asarray(curves, dtype=float)
+    if curves.ndim == 1:
+        curves = curves[:, None]
+    return PortfolioState.from_curves(curves).metrics(risk_free_rate)
+
+
+def calculate_metrics_frame(data, risk_free_rate=0.0):
+    """calculate_metrics of the columns of a DataFrame, one row per metric."""
+    metrics = calculate_metrics(data.to_numpy(dtype=float), risk_free_rate)
+    return pd.DataFrame(metrics, index=data.columns).T
@@ -4,6 +4,7 @@ import os
 import datetime
 from flask import current_app
 import pandas as pd
+from botocore.exceptions import ClientError
 
 
 def format_date(input_date, input_format="%Y-%m-%d", return_format="%Y-%m-%d %H:%M:%S"):
@@ -23,6 +24,10 @@ def format_date(input_date, input_format="%Y-%m-%d", return_format="%Y-%m-%d %H:
 
 
 class S3Mixin:
+    """
+    Access to the S3 bucket. Reads of data files are served from the local mirror
+    (S3_MIRROR) while it is fresh and go to S3 otherwise.
+    """
 
     def upload_file(self, file_object, name):
         s3_client = current_app.config["S3_CLIENT"]
@@ -33,11 +38,26 @@ class S3Mixin:
                 file_object,
                 name,
             )
+            self.refresh_mirror(name)
             return True
         except:
             return False
 
+    def refresh_mirror(self, path):
+        mirror = current_app.config.get("S3_MIRROR")
+        if mirror is not None:
+            mirror.refresh(path)
+
+    def get_mirrored_file(self, path):
+        mirror = current_app.config.get("S3_MIRROR")
+        if mirror is None:
+            return None, None
+        return mirror.get(path)
+
     def get_data_file(self, path):
+        mirrored_file, _ = self.get_mirrored_file(path)
+        if mirrored_file is not None:
+            return mirrored_file
         data_file = (
             current_app.config["S3_CLIENT"]
             .Object(current_app.config["S3_BUCKET"], path)
@@ -45,6 +65,33 @@ class S3Mixin:
         )
         return data_file["Body"]
 
+    def get_changed_data_file(self, path, version=None):
+        """
+        Conditional GET of a data file against the ETag of a cached copy.
+
+        Returns the body and the ETag of the object, or None and the given version
+        when the object did not change since.
+        """
+        mirrored_file, etag = self.get_mirrored_file(path)
+        if mirrored_file is not None:
+            if etag == version:
+                mirrored_file.close()
+                return None, version
+            return mirrored_file, etag
+        s3_object = current_app.config["S3_CLIENT"].Object(
+            current_app.config["S3_BUCKET"], path
+        )
+        try:
+            if version is None:
+                data_file = s3_object.get()
+            else:
+                data_file = s3_object.get(IfNoneMatch=version)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                return None, version
+            raise
+        return data_file["Body"], data_file["ETag"]
+
     def upload_files_to_s3(self, file_paths, folder_name):
         s3_client = current_app.config["S3_CLIENT"]
         bucket_name = current_app.config["S3_BUCKET"]
@@ -62,6 +109,7 @@ class S3Mixin:
             try:
                 # Upload the file to S3
                 s3_client.Bucket(bucket_name).upload_file(file_path, s3_key)
+                self.refresh_mirror(s3_key)
                 print(f"Successfully uploaded {file_path} to {s3_key}")
             except Exception as e:
                 print(f"Failed to upload {file_path} to {s3_key}: {e}")
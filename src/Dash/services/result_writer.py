@@ -0,0 +1,215 @@
+import os
+import ast
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from .metrics import METRICS, PortfolioState
+
+# The metrics are followed by the running state used by incremental recalibration
+RESULT_COLUMNS = ["name", "combination", "weights"] + list(
+    dict.fromkeys(METRICS + PortfolioState.COLUMNS)
+)
+
+
+class CSVBackend:
+    suffix = ".csv"
+    supports_resume = True
+
+    def __init__(self, path, offset=None):
+        if offset:
+            # Continue a resumed file, rows written after the checkpoint are dropped
+            os.truncate(path, offset)
+            self.file = open(path, "a", newline="")
+        else:
+            self.file = open(path, "w", newline="")
+        self.header_written = bool(offset)
+
+    def write(self, columns):
+        # Keep the python literal format of the combination and the weights
+        columns["combination"] = [str(tuple(value)) for value in columns["combination"]]
+        columns["weights"] = [str(list(value)) for value in columns["weights"]]
+        pd.DataFrame(columns).to_csv(
+            self.file, index=False, header=not self.header_written
+        )
+        self.header_written = True
+
+    def tell(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowBackend:
+    """Writes the batches as record batches, combination and weights are list columns."""
+
+    suffix = ".arrow"
+    supports_resume = False
+
+    def __init__(self, path, offset=None):
+        if offset:
+            raise ValueError(f"{self.suffix} result files can not be resumed")
+        self.path = path
+        self.writer = None
+
+    def to_table(self, columns):
+        columns["combination"] = [list(value) for value in columns["combination"]]
+        columns["weights"] = [list(value) for value in columns["weights"]]
+        return pa.Table.from_pydict(columns)
+
+    def open_writer(self, schema):
+        return pa.ipc.new_file(str(self.path), schema)
+
+    def write(self, columns):
+        table = self.to_table(columns)
+        if self.writer is None:
+            self.writer = self.open_writer(table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetBackend(ArrowBackend):
+    suffix = ".parquet"
+
+    def open_writer(self, schema):
+        return pq.ParquetWriter(str(self.path), schema)
+
+
+BACKENDS = {"csv": CSVBackend, "arrow": ArrowBackend, "parquet": ParquetBackend}
+
+
+class ResultWriter:
+    """
+    Collects calibration results in columnar buffers and writes them in large batches.
+
+    The rows go to a ".partial" file next to the target, which is renamed onto the
+    target when the writer is closed. Readers therefore never see a half written
+    result file. With resume_offset the partial file of an interrupted run is
+    continued from that offset, keep_partial keeps it when the writer is aborted.
+    """
+
+    def __init__(
+        self,
+        path,
+        backend="csv",
+        batch_size=100_000,
+        columns=None,
+        resume_offset=None,
+        keep_partial=False,
+    ):
+        self.backend_class = BACKENDS[backend]
+        self.path = Path(path).with_suffix(self.backend_class.suffix)
+        self.temp_path = self.path.with_name(self.path.name + ".partial")
+        self.batch_size = batch_size
+        self.columns = columns or RESULT_COLUMNS
+        self.keep_partial = keep_partial
+        self.supports_resume = self.backend_class.supports_resume
+        self.resumed = bool(resume_offset)
+        self.backend = self.backend_class(self.temp_path, resume_offset)
+        self.reset_buffer()
+
+    def reset_buffer(self):
+        self.buffer = {column: [] for column in self.columns}
+        self.buffered_rows = 0
+
+    def write_rows(self, **columns):
+        """Add a batch of rows, every column is a sequence of the same length."""
+        for column in self.columns:
+            self.buffer[column].append(columns[column])
+        self.buffered_rows += len(columns[self.columns[0]])
+        if self.buffered_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        columns = {}
+        for column, chunks in self.buffer.items():
+            if isinstance(chunks[0], np.ndarray):
+                columns[column] = np.concatenate(chunks)
+            else:
+                columns[column] = list(itertools.chain.from_iterable(chunks))
+        self.backend.write(columns)
+        self.reset_buffer()
+
+    def tell(self):
+        """Flush the buffer and return the size of the partial file."""
+        self.flush()
+        return self.backend.tell()
+
+    def close(self):
+        """Write the remaining rows and move the file into place."""
+        self.flush()
+        self.backend.close()
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self.backend.close()
+        if not self.keep_partial and self.temp_path.exists():
+            self.temp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_results(source, backend="csv"):
+    """Read a result file back into the columns ResultWriter.write_rows takes."""
+    if backend == "csv":
+        frame = pd.read_csv(source)
+        columns = {column: frame[column].to_numpy() for column in frame.columns}
+        # The literals repeat a lot, every distinct one is only parsed once
+        for column in ["combination", "weights"]:
+            literals = {value: ast.literal_eval(value) for value in set(frame[column])}
+            columns[column] = [literals[value] for value in frame[column]]
+        columns["combination"] = [tuple(value) for value in columns["combination"]]
+        columns["weights"] = [list(value) for value in columns["weights"]]
+    else:
+        if backend == "parquet":
+            table = pq.read_table(source)
+        else:
+            table = pa.ipc.open_file(source).read_all()
+        columns = {
+            column: table[column].to_numpy(zero_copy_only=False)
+            for column in table.column_names
+        }
+        columns["combination"] = [
+            tuple(value) for value in table["combination"].to_pylist()
+        ]
+        columns["weights"] = table["weights"].to_pylist()
+    columns["name"] = list(columns["name"])
+    return columns
+
+
+def write_ipc(source, target, backend="csv", batch_size=100_000):
+    """
+    Convert a result file into an uncompressed Arrow IPC file batch by batch, so only
+    one batch is held in memory at a time.
+    """
+    if backend == "parquet":
+        parquet_file = pq.ParquetFile(source)
+        schema = parquet_file.schema_arrow
+        batches = parquet_file.iter_batches(batch_size)
+    else:
+        batches = pa.csv.open_csv(source)
+        schema = batches.schema
+    with pa.ipc.new_file(str(target), schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
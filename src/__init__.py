@@ -23,6 +23,7 @@ from src.admin.s3FileAdmin import S3FileAdmin
 from src.services.logging import configure_logger
 from flask_admin.contrib.sqla import ModelView
 from src.services.cache import cache
+from src.services.s3_mirror import S3Mirror
 
 path = Path(__file__).resolve().parent / "Dash"
 # Get the directory containing your `src` folder
@@ -120,6 +121,15 @@ def create_app():
         aws_secret_access_key=os.environ.get("BUCKETEER_AWS_SECRET_ACCESS_KEY"),
     )
     app.config["S3_CLIENT"] = s3_client
+    if app.config["S3_MIRROR_ENABLED"]:
+        app.config["S3_MIRROR"] = S3Mirror(
+            s3_client,
+            app.config["S3_BUCKET"],
+            app.config["S3_MIRROR_DIRECTORY"],
+            interval=app.config["S3_MIRROR_INTERVAL"],
+            max_staleness=app.config["S3_MIRROR_MAX_STALENESS"],
+            logger=app.logger,
+        ).start()
 
     @app.before_request
     def check_login():
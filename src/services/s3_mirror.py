@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+
+class S3Mirror:
+    """
+    Keeps the objects below a prefix of a S3 bucket synced to a local directory.
+
+    A background thread lists the prefix every interval seconds and downloads the
+    objects whose ETag changed with a conditional GET. Reads are served from the
+    local copies as long as the last successful sync is at most max_staleness seconds
+    old, otherwise get returns nothing and the caller goes to S3 itself.
+
+    s3 is a boto3 S3 resource, or anything with the same Bucket / Object interface.
+    """
+
+    manifest_name = ".etags.json"
+
+    def __init__(
+        self,
+        s3,
+        bucket,
+        directory,
+        prefix="data/",
+        interval=30,
+        max_staleness=120,
+        logger=None,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.synced_at = None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.etags = self.load_manifest()
+
+    def local_path(self, key):
+        return self.directory / key
+
+    def load_manifest(self):
+        try:
+            with open(self.directory / self.manifest_name) as f:
+                etags = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {
+            key: etag for key, etag in etags.items() if self.local_path(key).exists()
+        }
+
+    def save_manifest(self):
+        with self.lock:
+            etags = dict(self.etags)
+        self.write_atomic(
+            self.directory / self.manifest_name,
+            lambda f: f.write(json.dumps(etags).encode()),
+        )
+
+    def write_atomic(self, path, write):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Several workers may mirror into the same directory, each one gets its own file
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def fetch(self, key):
+        """Download an object unless the local copy has its ETag. True if it changed."""
+        s3_object = self.s3.Object(self.bucket, key)
+        etag = self.etags.get(key)
+        try:
+            if etag is None:
+                response = s3_object.get()
+            else:
+                response = s3_object.get(IfNoneMatch=etag)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                return False
+            raise
+        self.write_atomic(
+            self.local_path(key),
+            lambda f: shutil.copyfileobj(response["Body"], f, 1024 * 1024),
+        )
+        with self.lock:
+            self.etags[key] = response["ETag"]
+        return True
+
+    def sync(self):
+        """Bring the local directory in line with the bucket."""
+        keys = set()
+        changed = False
+        for summary in self.s3.Bucket(self.bucket).objects.filter(Prefix=self.prefix):
+            if summary.key.endswith("/"):
+                continue
+            keys.add(summary.key)
+            if summary.e_tag != self.etags.get(summary.key):
+                changed = self.fetch(summary.key) or changed
+        for key in set(self.etags) - keys:
+            with self.lock:
+                del self.etags[key]
+            self.local_path(key).unlink(missing_ok=True)
+            changed = True
+        if changed:
+            self.save_manifest()
+        self.synced_at = time.monotonic()
+
+    def refresh(self, key):
+        """Fetch a single object right away, e.g. after it was uploaded."""
+        try:
+            if self.fetch(key):
+                self.save_manifest()
+        except Exception:
+            with self.lock:
+                self.etags.pop(key, None)
+            self.logger.exception(f"S3 mirror could not refresh {key}")
+
+    def is_fresh(self):
+        return (
+            self.synced_at is not None
+            and time.monotonic() - self.synced_at <= self.max_staleness
+        )
+
+    def get(self, key):
+        """
+        Open the local copy of an object. Returns the file and its ETag, or None and
+        None when the key is not mirrored or the mirror is too stale.
+        """
+        if not self.is_fresh():
+            return None, None
+        with self.lock:
+            etag = self.etags.get(key)
+            if etag is None:
+                return None, None
+            # A later replace of the file does not affect the opened one
+            return open(self.local_path(key), "rb"), etag
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                self.logger.exception("S3 mirror sync failed")
+            if self.stop_event.wait(self.interval):
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="s3-mirror", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the calibration engine against the per portfolio pandas loop it
+replaced, on the bundled Series.csv.
+
+    python tests/benchmark_calibration.py [partitions] [step_size]
+"""
+
+import sys
+import time
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from src.Dash.services.calibration import (  # noqa: E402
+    get_weight_matrix,
+    run_calibration,
+    shard_combinations,
+)
+from test_metrics import (  # noqa: E402
+    SERIES_PATH,
+    calc_metrics_pandas,
+    pandas_portfolio,
+)
+
+
+def load_prices():
+    df = pd.read_csv(SERIES_PATH, sep=",", header=0, decimal=".")
+    df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%Y")
+    return df.set_index("Date")
+
+
+def pandas_loop(prices, column_names, weight_matrices):
+    results = []
+    for partition, weight_matrix in weight_matrices.items():
+        for combination in itertools.combinations(column_names, partition):
+            for weights in weight_matrix:
+                portfolio = pandas_portfolio(prices, combination, weights)
+                results.append(calc_metrics_pandas(portfolio))
+    return np.array(results, dtype=float)
+
+
+def engine(prices, column_names, weight_matrices):
+    shards = shard_combinations(column_names, weight_matrices.keys(), 16)
+    results = []
+    for _, _, (_, columns) in run_calibration(prices, shards, weight_matrices):
+        results.append(
+            np.column_stack([columns["cagr"], columns["risk"], columns["age"]])
+        )
+    return np.vstack(results)
+
+
+def main(partitions=3, step_size=0.2):
+    prices = load_prices()
+    # The settings page calibrates all columns but the first two
+    column_names = list(prices.columns[2:])
+    weight_matrices = {
+        partition: get_weight_matrix(partition, step_size)
+        for partition in range(1, partitions + 1)
+    }
+    weight_matrices = {p: w for p, w in weight_matrices.items() if len(w)}
+
+    start = time.perf_counter()
+    expected = pandas_loop(prices, column_names, weight_matrices)
+    pandas_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = engine(prices, column_names, weight_matrices)
+    engine_time = time.perf_counter() - start
+
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+    print(f"{len(result)} portfolios, partitions 1-{partitions}, step {step_size}")
+    print(f"pandas loop: {pandas_time:.2f}s")
+    print(f"engine:      {engine_time:.2f}s ({pandas_time / engine_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main(*(float(arg) if "." in arg else int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,152 @@
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.Dash.services.calibration import calibrate_combination, get_weight_matrix
+from src.Dash.services.metrics import (
+    PortfolioState,
+    calculate_metrics,
+    calculate_metrics_frame,
+)
+
+SERIES_PATH = Path(__file__).resolve().parents[1] / "src/Dash/data/Series.csv"
+
+
+# The pandas implementations the metrics engine replaced, kept as reference
+
+
+def calc_CAGR(normalised_data, number_of_month=False):
+    if not number_of_month:
+        number_of_month = len(normalised_data)
+    cagr = (
+        normalised_data.iloc[-1].apply(
+            lambda x: (x / 100) ** (12 / number_of_month) - 1
+        )
+        * 100
+    )
+
+    risk = normalised_data / normalised_data.shift()
+    risk = risk[risk < 1.0].count() / number_of_month * 100
+    return cagr, risk
+
+
+def calc_metrics_pandas(portfolio):
+    number_of_months = len(portfolio)
+
+    temp = portfolio.iloc[-1] / 100
+    cagr = (temp ** (12 / number_of_months) - 1) * 100
+
+    risk = portfolio / portfolio.shift(1)
+    risk = risk.dropna()
+    risk_below_one = risk[risk < 1.0]
+    risk_count = len(risk_below_one)
+    risk_percentage = (risk_count / number_of_months) * 100
+
+    return cagr, risk_percentage, number_of_months
+
+
+def pandas_portfolio(prices, combination, weights):
+    """A portfolio built like the calibration loop before the matrix product."""
+    filtered_df = prices.dropna(subset=combination).copy()
+    for column in combination:
+        filtered_df[column] = filtered_df[column] / filtered_df[column].iloc[0] * 100
+    weighted_df = filtered_df.copy()
+    for i, column in enumerate(combination):
+        weighted_df[column] = weighted_df[column] * float(weights[i])
+    return weighted_df[list(combination)].sum(axis=1)
+
+
+def pandas_risk_metrics(portfolio):
+    returns = portfolio.pct_change().dropna()
+    volatility = returns.std() * np.sqrt(12) * 100
+    annual_return = returns.mean() * 12 * 100
+    downside = np.sqrt((np.minimum(returns, 0) ** 2).mean() * 12) * 100
+    peak = portfolio.cummax()
+    underwater = (portfolio < peak).astype(int)
+    duration = underwater.groupby((underwater == 0).cumsum()).cumsum().max()
+    twelve_months = portfolio.pct_change(12).dropna() * 100
+    return {
+        "volatility": volatility,
+        "max_drawdown": ((1 - portfolio / peak) * 100).max(),
+        "drawdown_duration": duration,
+        "sharpe": annual_return / volatility,
+        "sortino": annual_return / downside,
+        "best_12m": twelve_months.max(),
+        "worst_12m": twelve_months.min(),
+    }
+
+
+@pytest.fixture(scope="module")
+def prices():
+    df = pd.read_csv(SERIES_PATH, sep=",", header=0, decimal=".")
+    df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%Y")
+    return df.set_index("Date")
+
+
+@pytest.fixture(scope="module")
+def portfolios(prices):
+    """Portfolios of all pairs of ETFs as (combination, weights, pandas series)."""
+    weight_matrix = get_weight_matrix(2, 0.25)
+    result = []
+    for combination in itertools.combinations(prices.columns[1:], 2):
+        for weights in weight_matrix:
+            portfolio = pandas_portfolio(prices, combination, weights)
+            result.append((combination, weights, portfolio))
+    return result
+
+
+def test_calculate_metrics_matches_calc_CAGR(prices):
+    normalised = prices[["RI"]].dropna()
+    normalised = normalised / normalised.iloc[0] * 100
+    cagr, risk = calc_CAGR(normalised)
+    metrics = calculate_metrics_frame(normalised)
+    assert metrics.loc["cagr", "RI"] == pytest.approx(cagr["RI"], rel=1e-12)
+    assert metrics.loc["risk", "RI"] == pytest.approx(risk["RI"], rel=1e-12)
+    assert metrics.loc["age", "RI"] == len(normalised)
+
+
+def test_calculate_metrics_matches_pandas(portfolios):
+    for combination, weights, portfolio in portfolios:
+        cagr, risk, age = calc_metrics_pandas(portfolio)
+        metrics = calculate_metrics(portfolio.to_numpy())
+        assert metrics["cagr"][0] == pytest.approx(cagr, rel=1e-12)
+        assert metrics["risk"][0] == pytest.approx(risk, rel=1e-12)
+        assert metrics["age"][0] == age
+        for name, value in pandas_risk_metrics(portfolio).items():
+            assert metrics[name][0] == pytest.approx(value, rel=1e-9), name
+
+
+def test_calibrate_combination_matches_pandas(prices):
+    weight_matrix = get_weight_matrix(3, 0.25)
+    for combination in itertools.islice(
+        itertools.combinations(prices.columns[1:], 3), 20
+    ):
+        filtered = prices.dropna(subset=combination)[list(combination)]
+        normalised = filtered.to_numpy(dtype=float)
+        normalised = normalised / normalised[0] * 100
+        metrics = calibrate_combination(normalised, weight_matrix).metrics()
+        for i, weights in enumerate(weight_matrix):
+            portfolio = pandas_portfolio(prices, combination, weights)
+            cagr, risk, age = calc_metrics_pandas(portfolio)
+            assert metrics["cagr"][i] == pytest.approx(cagr, rel=1e-12)
+            assert metrics["risk"][i] == pytest.approx(risk, rel=1e-12)
+            assert metrics["age"][i] == age
+
+
+@pytest.mark.parametrize("history", [1, 11, 12, 13, 40])
+def test_update_matches_full_calculation(portfolios, history):
+    # The months all portfolios have in common
+    months = min(len(portfolio) for _, _, portfolio in portfolios)
+    curves = np.column_stack(
+        [portfolio.to_numpy()[-months:] for _, _, portfolio in portfolios]
+    )
+    curves = curves / curves[0] * 100
+    state = PortfolioState.from_curves(curves[:history])
+    state.update(curves[history:], curves[max(history - 12, 0) : history])
+    updated = state.metrics()
+    full = PortfolioState.from_curves(curves).metrics()
+    for name, values in full.items():
+        np.testing.assert_allclose(updated[name], values, rtol=1e-12, err_msg=name)
@@ -0,0 +1,122 @@
+import hashlib
+import io
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+from src.services.s3_mirror import S3Mirror
+
+
+class FakeS3:
+    """In-memory stand-in for the parts of a boto3 S3 resource the mirror uses."""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.gets = []
+
+    def etag(self, key):
+        return '"' + hashlib.md5(self.objects[key]).hexdigest() + '"'
+
+    def Bucket(self, name):
+        def filter(Prefix=""):
+            return [
+                SimpleNamespace(key=key, e_tag=self.etag(key))
+                for key in sorted(self.objects)
+                if key.startswith(Prefix)
+            ]
+
+        return SimpleNamespace(objects=SimpleNamespace(filter=filter))
+
+    def Object(self, bucket, key):
+        def get(IfNoneMatch=None):
+            self.gets.append((key, IfNoneMatch))
+            if key not in self.objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            if IfNoneMatch == self.etag(key):
+                raise ClientError({"Error": {"Code": "304"}}, "GetObject")
+            return {"Body": io.BytesIO(self.objects[key]), "ETag": self.etag(key)}
+
+        return SimpleNamespace(get=get)
+
+
+@pytest.fixture
+def s3():
+    return FakeS3({"data/Series.csv": b"Date,RI\n", "data/new_result.csv": b"name\n"})
+
+
+def read(mirror, key):
+    mirrored_file, etag = mirror.get(key)
+    with mirrored_file:
+        return mirrored_file.read(), etag
+
+
+def test_sync_mirrors_the_prefix(s3, tmp_path):
+    s3.objects["other/file.csv"] = b"ignored"
+    mirror = S3Mirror(s3, "bucket", tmp_path)
+    mirror.sync()
+    assert read(mirror, "data/Series.csv") == (b"Date,RI\n", s3.etag("data/Series.csv"))
+    assert mirror.get("other/file.csv") == (None, None)
+    manifest = json.loads((tmp_path / S3Mirror.manifest_name).read_text())
+    assert set(manifest) == {"data/Series.csv", "data/new_result.csv"}
+
+
+def test_sync_only_fetches_changed_objects(s3, tmp_path):
+    mirror = S3Mirror(s3, "bucket", tmp_path)
+    mirror.sync()
+    s3.gets.clear()
+    mirror.sync()
+    assert s3.gets == []
+
+    old_etag = s3.etag("data/Series.csv")
+    s3.objects["data/Series.csv"] = b"Date,RI\n01/01/2024,1\n"
+    mirror.sync()
+    assert s3.gets == [("data/Series.csv", old_etag)]
+    assert read(mirror, "data/Series.csv")[0] == b"Date,RI\n01/01/2024,1\n"
+
+
+def test_sync_removes_deleted_objects(s3, tmp_path):
+    mirror = S3Mirror(s3, "bucket", tmp_path)
+    mirror.sync()
+    del s3.objects["data/new_result.csv"]
+    mirror.sync()
+    assert mirror.get("data/new_result.csv") == (None, None)
+    assert not (tmp_path / "data/new_result.csv").exists()
+
+
+def test_stale_mirror_is_not_served(s3, tmp_path):
+    mirror = S3Mirror(s3, "bucket", tmp_path, max_staleness=5)
+    assert mirror.get("data/Series.csv") == (None, None)
+    mirror.sync()
+    assert mirror.get("data/Series.csv")[0] is not None
+    mirror.synced_at -= 10
+    assert mirror.get("data/Series.csv") == (None, None)
+
+
+def test_restart_reuses_the_manifest(s3, tmp_path):
+    S3Mirror(s3, "bucket", tmp_path).sync()
+    s3.gets.clear()
+    S3Mirror(s3, "bucket", tmp_path).sync()
+    assert s3.gets == []
+
+
+def test_refresh_fetches_an_uploaded_object(s3, tmp_path):
+    mirror = S3Mirror(s3, "bucket", tmp_path)
+    mirror.sync()
+    s3.objects["data/new_result.parquet"] = b"PAR1"
+    mirror.refresh("data/new_result.parquet")
+    assert read(mirror, "data/new_result.parquet")[0] == b"PAR1"
+
+
+def test_background_thread_syncs(s3, tmp_path):
+    mirror = S3Mirror(s3, "bucket", tmp_path, interval=0.01).start()
+    try:
+        deadline = time.monotonic() + 5
+        while not mirror.is_fresh() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert read(mirror, "data/Series.csv")[0] == b"Date,RI\n"
+    finally:
+        mirror.stop()
+    assert not mirror.thread.is_alive()